@@ -1,13 +1,19 @@
+import asyncio
+import hmac
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from app.database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import AsyncSessionLocal, get_async_db
 from app.models import User
+from app.schemas import Principal
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,10 +21,53 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+PRINCIPAL_CACHE_MAX_SIZE = int(os.getenv("PRINCIPAL_CACHE_MAX_SIZE", "10000"))
+# bcrypt : threads dédiés (bcrypt libère le GIL) et file d'attente bornée
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "10"))
+# Jeton Bearer du scraper Prometheus pour /metrics (vide : réservé aux administrateurs connectés)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
+# Cache des utilisateurs authentifiés : {user_id: (expire_at, Principal)}
+# Invalidé explicitement par update_user/delete_user ; le TTL borne le décalage entre workers.
+_principal_cache: Dict[str, Tuple[float, Principal]] = {}
+
+
+def get_cached_principal(user_id: str) -> Optional[Principal]:
+    """Retourne le Principal en cache s'il n'a pas expiré"""
+    entry = _principal_cache.get(user_id)
+    if entry is None:
+        return None
+    expire_at, principal = entry
+    if expire_at < time.monotonic():
+        _principal_cache.pop(user_id, None)
+        return None
+    return principal
+
+
+def cache_principal(principal: Principal):
+    """Met un Principal en cache (évince les plus anciennes entrées au-delà de la taille max)"""
+    key = str(principal.id)
+    _principal_cache.pop(key, None)
+    while len(_principal_cache) >= PRINCIPAL_CACHE_MAX_SIZE:
+        _principal_cache.pop(next(iter(_principal_cache)))
+    _principal_cache[key] = (time.monotonic() + PRINCIPAL_CACHE_TTL, principal)
+
+
+def invalidate_principal(user_id):
+    """Retire un utilisateur du cache (après modification ou suppression)"""
+    _principal_cache.pop(str(user_id), None)
+
+
+_password_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+# Nombre maximal de hachages en cours ou en attente (au-delà : 503)
+_password_hash_slots = asyncio.Semaphore(PASSWORD_HASH_MAX_PENDING)
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Vérifie si le mot de passe en clair correspond au hash"""
@@ -30,6 +79,33 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+async def _run_password_hash(func, *args):
+    """Exécute un calcul bcrypt dans le pool dédié, sans bloquer la boucle asyncio"""
+    try:
+        await asyncio.wait_for(_password_hash_slots.acquire(), timeout=PASSWORD_HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many authentication requests, please retry",
+            headers={"Retry-After": "1"},
+        )
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_hash_executor, func, *args)
+    finally:
+        _password_hash_slots.release()
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """verify_password exécuté dans le pool bcrypt"""
+    return await _run_password_hash(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """get_password_hash exécuté dans le pool bcrypt"""
+    return await _run_password_hash(get_password_hash, password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Crée un token JWT"""
     to_encode = data.copy()
@@ -42,18 +118,18 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-def authenticate_user(db: Session, email: str, password: str) -> Optional[User]:
+async def authenticate_user(db: AsyncSession, email: str, password: str) -> Optional[User]:
     """Authentifie un utilisateur"""
-    user = db.query(User).filter(User.email == email).first()
+    user = (await db.execute(select(User).where(User.email == email))).scalars().first()
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
         return None
     return user
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
-    """Récupère l'utilisateur actuel à partir du token JWT"""
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)) -> Principal:
+    """Récupère l'utilisateur actuel à partir du token JWT (via le cache des Principal)"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -68,20 +144,27 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     except JWTError:
         raise credentials_exception
     
-    user = db.query(User).filter(User.id == id).first()
-    if user is None:
+    principal = get_cached_principal(id)
+    if principal is not None:
+        return principal
+
+    stmt = select(User.id, User.type, User.is_active).where(User.id == id)
+    row = (await db.execute(stmt)).first()
+    if row is None:
         raise credentials_exception
-    return user
+    principal = Principal(id=row.id, type=row.type, is_active=row.is_active)
+    cache_principal(principal)
+    return principal
 
 
-def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
+def get_current_active_user(current_user: Principal = Depends(get_current_user)) -> Principal:
     """Vérifie que l'utilisateur actuel est actif"""
     print(current_user)
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
-def get_current_sco_user(current_user: User = Depends(get_current_active_user)) -> User:
+def get_current_sco_user(current_user: Principal = Depends(get_current_active_user)) -> Principal:
     """Vérifie que l'utilisateur actuel est un personnel de la scolarite"""
     if current_user.type != "sco":
         raise HTTPException(
@@ -90,7 +173,7 @@ def get_current_sco_user(current_user: User = Depends(get_current_active_user))
         )
     return current_user
 
-def get_current_sco_or_admin_user(current_user: User = Depends(get_current_active_user)) -> User:
+def get_current_sco_or_admin_user(current_user: Principal = Depends(get_current_active_user)) -> Principal:
     """Vérifie que l'utilisateur actuel est un personnel de la scolarite"""
     if current_user.type not in ["sco", "admin"]:
         raise HTTPException(
@@ -99,7 +182,7 @@ def get_current_sco_or_admin_user(current_user: User = Depends(get_current_activ
         )
     return current_user
 
-def get_current_admin_user(current_user: User = Depends(get_current_active_user)) -> User:
+def get_current_admin_user(current_user: Principal = Depends(get_current_active_user)) -> Principal:
     """Vérifie que l'utilisateur actuel est un administrateur"""
     if current_user.type != "admin":
         raise HTTPException(
@@ -109,3 +192,11 @@ def get_current_admin_user(current_user: User = Depends(get_current_active_user)
     return current_user
 
 
+async def get_metrics_access(token: str = Depends(oauth2_scheme)):
+    """Autorise /metrics : jeton METRICS_TOKEN (scraper) ou JWT d'un administrateur actif"""
+    if METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return
+    # Session ouverte seulement pour un JWT : les scrapes ne comptent pas dans les métriques de sessions
+    async with AsyncSessionLocal() as db:
+        principal = await get_current_user(token, db)
+    get_current_admin_user(get_current_active_user(principal))
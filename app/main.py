@@ -1,52 +1,112 @@
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, Query, Request
+from fastapi.responses import StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager
 from datetime import timedelta
-from typing import List
+from typing import List, Literal, Optional
+from uuid import UUID
 
 from starlette.status import HTTP_201_CREATED, HTTP_200_OK
 
-from app.database import get_db, engine, Base
-from app.models import User, Document, Niveau, Notification
+from app.database import get_db, get_async_db, AsyncSessionLocal, SessionLocal, engine, Base, DB_CREATE_ALL_ON_STARTUP
+from app.models import User
 from app.schemas import (
     UserCreate, UserResponse, UserUpdate, Token, LoginRequest, UserRequestFilter,
-    DocumentRequestCreate, DocumentRequestResponse, DocumentRequestUpdate, DocumentRequestCLientUpdate,
+    DocumentRequestResponse, DocumentRequestUpdate, DocumentRequestCLientUpdate,
     DocumentRequestFilter, PaginatedDocumentRequestResponse, DocumentCreateSchema,
-    MultipleRequestsCreate, NotificationMessage,
     NiveauResponseSchema, NiveauCreateRequest,
     CategoriCreateRequest, CategoriResponseSchema,
-    NotificationResponseSchema, NotificationSeenSchema,
-    PaginatedUserRequestResponse, AblyMessage, CategorieMinorUpdateSchema
+    NotificationResponseSchema, NotificationSeenSchema, UserCountersResponse,
+    PaginatedUserRequestResponse, AblyMessage, CategorieMinorUpdateSchema, Principal,
+    sparse_page_model, CompactDocumentRequestResponse, CompactPaginatedDocumentRequestResponse, IncludedEntities,
+    sparse_compact_page_model
 )
 from app.auth import (
     authenticate_user, create_access_token, get_current_active_user,
-    get_current_sco_or_admin_user, get_current_sco_user,
-    get_current_admin_user, ACCESS_TOKEN_EXPIRE_MINUTES
+    get_current_sco_or_admin_user,
+    get_current_admin_user, get_metrics_access, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 from app.crud import (
     create_user, get_user_by_email, get_user_by_id, get_all_users,
     get_pending_users, update_user, delete_user,
     create_document_request,
-    get_document_request_by_id, get_all_document_requests, get_document_requests_filtered,
-    get_user_document_requests, update_document_request, update_document_client_request, delete_document_request,
-    get_all_niveau, create_niveau, update_niveau, delete_niveau, get_a_niveau,
-    get_a_categori, get_all_categori, create_categori, update_categori, delete_categori,
-    get_notification_for_active_user, mark_as_seen, get_all_stats_for_dashboard,
-update_minor_categori
+    get_document_request_by_id, get_document_requests_filtered,
+    update_document_request, update_document_client_request, delete_document_request,
+    stream_document_requests, document_fieldset, user_fieldset,
+    create_niveau, update_niveau, delete_niveau, get_a_niveau,
+    get_a_categori, create_categori, update_categori, delete_categori,
+    get_notification_for_active_user, mark_as_seen, mark_all_as_seen, count_unread_notifications, get_all_stats_for_dashboard,
+update_minor_categori, get_all_niveau_cached, get_all_categori_cached
 )
-from app.services.websocket_manager import manager
-from app.services.ably_service import send_message
+from app.services.websocket_manager import manager, WEBSOCKET_PING_INTERVAL, WEBSOCKET_PING_TIMEOUT
+from app.services.ably_service import send_message, ably_publisher, AblyPublishError
+from app.services.outbox import outbox_dispatcher
+from app.services.user_counters import counter_reconciler, get_user_counters
+from app.services.mail_service import mail_sender
+from app.services.export_service import iter_ndjson, iter_csv
+from app.services.reference_cache import reference_cache, CachedReference
+from app.services.metrics import metrics_registry
+
+def _create_tables():
+    """Créer les tables de la base de données"""
+    Base.metadata.create_all(bind=engine)
+
+
+def _warm_reference_cache():
+    db = SessionLocal()
+    try:
+        get_all_niveau_cached(db)
+        get_all_categori_cached(db)
+    finally:
+        db.close()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Démarrage/arrêt explicites : rien ne touche la base ni le réseau à l'import du module,
+    les clients Ably et SMTP sont créés au premier envoi.
+    """
+    if DB_CREATE_ALL_ON_STARTUP:
+        await run_in_threadpool(_create_tables)
+
+    # Charge les niveaux et catégories en mémoire dès le démarrage
+    try:
+        await run_in_threadpool(_warm_reference_cache)
+    except Exception as e:
+        # Le cache se remplira au premier appel
+        print(f"Impossible de précharger les données de référence : {e}")
+
+    # Abonne ce worker au backplane WebSocket (LISTEN/NOTIFY si WEBSOCKET_BACKPLANE=postgres)
+    await manager.start()
+    # Workers qui envoient les effets de bord (Ably, email, WebSocket) de l'outbox
+    mail_sender.start()
+    ably_publisher.start()
+    outbox_dispatcher.start()
+    # Réparation périodique des compteurs utilisateur (badges)
+    counter_reconciler.start()
+    try:
+        yield
+    finally:
+        await counter_reconciler.stop()
+        await outbox_dispatcher.stop()
+        await ably_publisher.stop()
+        await mail_sender.stop()
+        await manager.stop()
 
-# Créer les tables de la base de données
-Base.metadata.create_all(bind=engine)
 
 app = FastAPI(
     title="API Gestion Documents Étudiants",
     description="API pour la gestion des demandes de documents administratifs",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+
 # Configuration CORS
 app.add_middleware(
     CORSMiddleware,
@@ -54,30 +114,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lisible par le navigateur : curseur de la boîte de réception
+    expose_headers=["X-Next-Cursor"],
 )
 
 
 # ==================== ROUTES D'AUTHENTIFICATION ====================
 
 @app.post("/auth/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def register(user: UserCreate, background_task: BackgroundTasks, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
     """Inscription d'un nouvel utilisateur (compte non actif par défaut)"""
     # Vérifier si l'email existe déjà
-    db_user = get_user_by_email(db, email=user.email)
+    db_user = await get_user_by_email(db, email=user.email)
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
     
-    new_user = await create_user(db=db, user=user, background_task=background_task)
+    new_user = await create_user(db=db, user=user)
     return new_user
 
 
 @app.post("/auth/login", response_model=Token)
-async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
+async def login(login_data: LoginRequest, db: AsyncSession = Depends(get_async_db)):
     """Connexion d'un utilisateur"""
-    user = authenticate_user(db, login_data.email, login_data.password)
+    user = await authenticate_user(db, login_data.email, login_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -99,21 +161,48 @@ async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
 
 
 # ==================== ROUTES POUR UTILISATEURS ====================
+def _sparse_page_response(schema, fieldset, rows, pagination_meta) -> Response:
+    """
+    Page réduite aux champs demandés. Sérialisée ici avec un modèle dérivé de `schema` :
+    la Response est renvoyée telle quelle (response_model documente la forme complète).
+    """
+    page = sparse_page_model(schema, fieldset)(data=rows, pagination=pagination_meta)
+    return Response(content=page.model_dump_json(), media_type="application/json")
+
 
 @app.get("/users/me", response_model=UserResponse)
-async def read_users_me(current_user: User = Depends(get_current_active_user)):
+async def read_users_me(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
     """Récupère les informations de l'utilisateur connecté"""
-    return current_user
+    # Le Principal en cache ne contient que id/type/is_active : on charge le profil complet
+    db_user = await get_user_by_id(db, user_id=current_user.id)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return db_user
+
+
+@app.get("/users/me/counters", response_model=UserCountersResponse)
+async def read_users_me_counters(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    """Badges de l'utilisateur connecté (lecture d'une ligne, indépendante de l'historique)"""
+    return await get_user_counters(db, current_user.id)
 
 
 @app.get("/users", response_model=PaginatedUserRequestResponse)
 async def read_all_users(
     data: UserRequestFilter = Depends(),
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     """Récupère tous les utilisateurs (admin seulement)"""
-    users, pagination_meta = get_all_users(db, data)
+    users, pagination_meta = await get_all_users(db, data)
+    fieldset = user_fieldset(data)
+    if fieldset is not None:
+        return _sparse_page_response(UserResponse, fieldset, users, pagination_meta)
     result = PaginatedUserRequestResponse(
         data=users,
         pagination=pagination_meta
@@ -123,22 +212,22 @@ async def read_all_users(
 
 @app.get("/users/pending", response_model=List[UserResponse])
 async def read_pending_users(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     """Récupère les utilisateurs en attente de validation (admin seulement)"""
-    users = get_pending_users(db)
+    users = await get_pending_users(db)
     return users
 
 
 @app.get("/users/{user_id}", response_model=UserResponse)
 async def read_user(
     user_id: str,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     """Récupère un utilisateur par son ID (admin seulement)"""
-    db_user = get_user_by_id(db, user_id=user_id)
+    db_user = await get_user_by_id(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
@@ -148,24 +237,14 @@ async def read_user(
 async def update_user_endpoint(
     user_id: str,
     user_update: UserUpdate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     """Met à jour un utilisateur (admin seulement)"""
-    print(user_id)
-    db_user = update_user(db, user_id=user_id, user_update=user_update)
+    # La notification WebSocket (is_active) est écrite dans l'outbox par update_user
+    db_user = await update_user(db, user_id=user_id, user_update=user_update)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    # Envoyer une notification si le statut is_active change
-    if user_update.is_active is not None:
-        notification_type = "account_validated" if user_update.is_active else "account_rejected"
-        notification_message = {
-            "type": notification_type,
-            "message": f"Votre compte a été {'validé' if user_update.is_active else 'refusé'}",
-            "data": {"user_id": user_id, "is_active": user_update.is_active}
-        }
-        await manager.send_personal_message(notification_message, user_id)
     db_user.id = str(db_user.id)
     return db_user
 
@@ -173,11 +252,11 @@ async def update_user_endpoint(
 @app.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_user_endpoint(
     user_id: str,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     """Supprime un utilisateur (admin seulement)"""
-    success = delete_user(db, user_id=user_id)
+    success = await delete_user(db, user_id=user_id)
     if not success:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -187,19 +266,26 @@ async def delete_user_endpoint(
 @app.get("/requests", response_model=PaginatedDocumentRequestResponse)
 async def read_demand_all_requests(
     filters: DocumentRequestFilter = Depends(),
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """
     Récupère les demandes de documents avec support de pagination et de filtres.
     Retourne les données et les métadonnées de pagination.
+    Avec fields= / include=, seuls les champs et relations demandés sont lus et renvoyés.
+    Avec compact=true, utilisateurs et catégories sont dédoublonnés dans `included`.
     """
 
-    documents, pagination_meta = get_document_requests_filtered(
+    documents, pagination_meta = await get_document_requests_filtered(
         db,
         filters=filters,
         current_user=current_user
     )
+    fieldset = document_fieldset(filters)
+    if filters.compact:
+        return _compact_page_response(fieldset, documents, pagination_meta)
+    if fieldset is not None:
+        return _sparse_page_response(DocumentRequestResponse, fieldset, documents, pagination_meta)
 
     # Construction de la réponse finale
     return PaginatedDocumentRequestResponse(
@@ -208,14 +294,67 @@ async def read_demand_all_requests(
     )
 
 
+def _compact_page_response(fieldset, documents, pagination_meta) -> Response:
+    """
+    Page compacte : chaque utilisateur et chaque catégorie n'est sérialisé qu'une fois dans `included`,
+    les lignes n'en gardent que l'id. Avec fields= / include=, seules les relations demandées sont émises.
+    """
+    names = fieldset if fieldset is not None else tuple(DocumentRequestResponse.model_fields)
+    with_users = "user" in names
+    with_categories = "categorie" in names
+
+    included = IncludedEntities(
+        users={document.user_id: document.user for document in documents if with_users and document.user is not None},
+        categories={document.categorie_id: document.categorie for document in documents if with_categories},
+    )
+    if fieldset is None:
+        page_model = CompactPaginatedDocumentRequestResponse
+    else:
+        # Les relations émises dans `included` sont remplacées par leur clé dans les lignes
+        row_names = tuple(
+            name for name in CompactDocumentRequestResponse.model_fields
+            if name in names or (name == "user_id" and with_users) or (name == "categorie_id" and with_categories)
+        )
+        page_model = sparse_compact_page_model(row_names)
+
+    page = page_model(data=documents, included=included, pagination=pagination_meta)
+    return Response(content=page.model_dump_json(), media_type="application/json")
+
+
+@app.get("/requests/export")
+async def export_demand_requests(
+    filters: DocumentRequestFilter = Depends(),
+    export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    """
+    Exporte toutes les demandes filtrées en flux (NDJSON ou CSV).
+    Les paramètres de pagination sont ignorés : les lignes sont lues par lots
+    via un curseur serveur et envoyées au fur et à mesure.
+    """
+    async def partitions():
+        # Session propre au flux : elle reste ouverte pendant tout l'envoi de la réponse
+        async with AsyncSessionLocal() as db:
+            async for partition in stream_document_requests(db, filters=filters, current_user=current_user):
+                yield partition
+
+    if export_format == "csv":
+        return StreamingResponse(
+            iter_csv(partitions()),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="requests.csv"'}
+        )
+    return StreamingResponse(iter_ndjson(partitions()), media_type="application/x-ndjson")
+
+
 @app.get("/requests/{request_id}", response_model=DocumentRequestResponse)
 async def read_single_demand_request(
     request_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Récupère une demande par son ID"""
-    db_request = get_document_request_by_id(db, request_id=request_id)
+    db_request = await get_document_request_by_id(db, request_id=request_id)
     if db_request is None:
         raise HTTPException(status_code=404, detail="Request not found")
     
@@ -229,17 +368,15 @@ async def read_single_demand_request(
 @app.post("/requests",response_model=DocumentRequestResponse,status_code=status.HTTP_201_CREATED)
 async def create_requests(
     requests_data: DocumentCreateSchema,
-    background_task: BackgroundTasks,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     # requests_data: MultipleRequestsCreate,
     """Crée une ou plusieurs demandes de documents en une seule requête"""
     db_requests = await create_document_request(
         db=db,
         request=requests_data,
-        user_id=str(current_user.id),
-        background_task=background_task
+        user_id=str(current_user.id)
     )
     return db_requests
 
@@ -247,17 +384,15 @@ async def create_requests(
 async def validate_request(
     request_id: int,
     request_update: DocumentRequestUpdate,
-        background_task: BackgroundTasks,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_sco_or_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_sco_or_admin_user)
 ):
     """Met à jour le statut d'une demande (admin seulement)"""
-    db_request = get_document_request_by_id(db, request_id=request_id)
+    db_request = await get_document_request_by_id(db, request_id=request_id)
     if db_request is None:
         raise HTTPException(status_code=404, detail="Request not found")
 
-    old_status = db_request.status
-    updated_request = await update_document_request(db, request_id=request_id, request_update=request_update, background_task=background_task)
+    updated_request = await update_document_request(db, request_id=request_id, request_update=request_update)
     return updated_request
 
 
@@ -265,11 +400,11 @@ async def validate_request(
 async def update_for_client_request(
     request_id: int,
     request_update: DocumentRequestCLientUpdate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Met à jour le statut d'une demande (admin seulement)"""
-    db_requests = update_document_client_request(
+    db_requests = await update_document_client_request(
         db=db,
         request=request_update,
         document_id=request_id
@@ -280,31 +415,42 @@ async def update_for_client_request(
 @app.delete("/requests/{request_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_request(
     request_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
     """Supprime une demande (admin seulement)"""
-    success = delete_document_request(db, request_id=request_id)
+    success = await delete_document_request(db, request_id=request_id)
     if not success:
         raise HTTPException(status_code=404, detail="Request not found")
 
 
 
 # ==================== ROUTES NIVEAU (CRUD) ====================
+def _reference_response(request: Request, entry: CachedReference) -> Response:
+    """Réponse JSON pré-sérialisée depuis le cache, avec ETag / Cache-Control (304 si inchangée)"""
+    headers = reference_cache.cache_headers(entry)
+    if reference_cache.is_not_modified(entry, request.headers.get("if-none-match")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
 @app.get("/niveau", response_model=List[NiveauResponseSchema])
 def read_requests(
+    request: Request,
     db: Session = Depends(get_db),
-    # current_user: User = Depends(get_current_active_user)
+    # current_user: Principal = Depends(get_current_active_user)
 ):
-    result = get_all_niveau(db)
-    return result
+    return _reference_response(request, get_all_niveau_cached(db))
 
 @app.get("/niveau/{niveau_id}", response_model=NiveauResponseSchema)
 def read_unique_requests(
     niveau_id: int,
     db: Session = Depends(get_db),
-    # current_user: User = Depends(get_current_active_user)
+    # current_user: Principal = Depends(get_current_active_user)
 ):
+    cached = get_all_niveau_cached(db).by_id.get(niveau_id)
+    if cached is not None:
+        return cached
     result = get_a_niveau(db, niveau_id)
     return result
 
@@ -313,7 +459,7 @@ def read_unique_requests(
 def create_niveau_requests(
     request_data: NiveauCreateRequest,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     result = create_niveau(db, request_data)
     return result
@@ -324,7 +470,7 @@ def update_niveau_requests(
     niveau_id: int,
     request_data: NiveauCreateRequest,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     result = update_niveau(db, request_data, niveau_id)
     return result
@@ -333,7 +479,7 @@ def update_niveau_requests(
 async def delete_niveau_request(
     niveau_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     """Supprime une demande (admin seulement)"""
     success = delete_niveau(db, niveau_id)
@@ -343,18 +489,21 @@ async def delete_niveau_request(
 # ==================== ROUTES CATEGORIES (CRUD) ====================
 @app.get("/categori", response_model=List[CategoriResponseSchema])
 def read_requests(
+    request: Request,
     db: Session = Depends(get_db),
-    # current_user: User = Depends(get_current_active_user)
+    # current_user: Principal = Depends(get_current_active_user)
 ):
-    result = get_all_categori(db)
-    return result
+    return _reference_response(request, get_all_categori_cached(db))
 
 @app.get("/categori/{categori_id}", response_model=CategoriResponseSchema)
 def read_unique_requests(
     categori_id: int,
     db: Session = Depends(get_db),
-    # current_user: User = Depends(get_current_active_user)
+    # current_user: Principal = Depends(get_current_active_user)
 ):
+    cached = get_all_categori_cached(db).by_id.get(categori_id)
+    if cached is not None:
+        return cached
     result = get_a_categori(db, categori_id)
     return result
 
@@ -363,7 +512,7 @@ def read_unique_requests(
 def create_niveau_requests(
     request_data: CategoriCreateRequest,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     result = create_categori(db, request_data)
     return result
@@ -373,7 +522,7 @@ def update_categori_requests(
     categori_id: int,
     request_data: CategoriCreateRequest,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     result = update_categori(db, request_data, categori_id)
     return result
@@ -384,7 +533,7 @@ def update_categori_requests(
     categori_id: int,
     request_data: CategorieMinorUpdateSchema,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     result = update_minor_categori(db, request_data, categori_id)
     return result
@@ -393,7 +542,7 @@ def update_categori_requests(
 async def delete_categori_request(
     categori_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
+    current_user: Principal = Depends(get_current_admin_user)
 ):
     """Supprime une demande (admin seulement)"""
     success = delete_categori(db, categori_id)
@@ -402,27 +551,56 @@ async def delete_categori_request(
 
 
 # ==================== ROUTES NOTIFICATION =====================
+@app.get("/notification/unread_count", status_code=HTTP_200_OK)
+async def notification_unread_count(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    """Nombre de notifications non lues (badge) sans charger la boîte de réception"""
+    return {"unread": await count_unread_notifications(db, current_user.id)}
+
 @app.get("/notification", response_model=List[NotificationResponseSchema])
-def notification_requests(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+async def notification_requests(
+    response: Response,
+    per_page: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = None,
+    unread: bool = False,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
-    result = get_notification_for_active_user(db, current_user.id)
+    """
+    Boîte de réception paginée (plus récentes d'abord). Le curseur de la page suivante
+    est renvoyé dans l'en-tête X-Next-Cursor (absent sur la dernière page).
+    """
+    result, next_cursor = await get_notification_for_active_user(
+        db, current_user.id, per_page=per_page, cursor=cursor, unread_only=unread
+    )
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
     return result
 
+@app.put("/notification/read_all", status_code=HTTP_200_OK)
+async def notification_read_all_requests(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    """Marque toute la boîte de réception comme lue (un seul UPDATE)"""
+    rows_updated = await mark_all_as_seen(db, current_user.id)
+    return {"message": f"{rows_updated} notification(s) marquée(s) comme lue(s)."}
+
 @app.put("/notification", status_code=HTTP_200_OK)
-def notification_unseen_requests(
+async def notification_unseen_requests(
     data: NotificationSeenSchema,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
-    rows_updated = mark_as_seen(db, data.notif_ids, current_user.id)
+    rows_updated = await mark_as_seen(db, data.notif_ids, current_user.id)
     return {"message": f"{rows_updated} notification(s) marquée(s) comme lue(s)."}
 
 @app.get("/stats/dashboard", status_code=HTTP_200_OK)
 async def dashboard_stat_requests(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_sco_or_admin_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_sco_or_admin_user)
 ):
     stats = await get_all_stats_for_dashboard(db)
     return stats
@@ -453,7 +631,10 @@ async def test_realtime():
         publisher="register",
         content="Hello world"
     )
-    await send_message(msg)
+    try:
+        await send_message(msg)
+    except AblyPublishError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
     return {"status": "success", "sent": True}
 
@@ -473,20 +654,36 @@ async def test_realtime():
 
 # ==================== ROUTES WEBSOCKET ====================
 
+async def _websocket_role(user_id: str):
+    """Rôle de l'utilisateur, pour l'indexer (les diffusions admins ne visent que admin/sco)"""
+    try:
+        uid = UUID(user_id)
+    except ValueError:
+        return None
+    async with AsyncSessionLocal() as db:
+        return await db.scalar(select(User.type).where(User.id == uid))
+
+
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
     """Endpoint WebSocket pour les notifications en temps réel"""
-    await manager.connect(websocket, user_id)
+    await manager.connect(websocket, user_id, await _websocket_role(user_id))
     try:
         while True:
             # Écouter les messages (optionnel, pour le ping/pong)
             data = await websocket.receive_text()
             # On peut répondre avec un pong si nécessaire
-            await websocket.send_json({"type": "pong", "message": "Connection alive"})
+            manager.reply(websocket, {"type": "pong", "message": "Connection alive"})
     except WebSocketDisconnect:
         manager.disconnect(websocket, user_id)
 
 
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(get_metrics_access)])
+async def metrics():
+    """Métriques du processus (pool de connexions, sessions) au format texte Prometheus"""
+    return Response(content=metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/")
 async def root():
     """Point d'entrée de l'API"""
@@ -500,6 +697,10 @@ async def root():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        app, host="0.0.0.0", port=8000,
+        # Heartbeat WebSocket par trames ping/pong du protocole (implémentation websockets d'uvicorn)
+        ws_ping_interval=WEBSOCKET_PING_INTERVAL, ws_ping_timeout=WEBSOCKET_PING_TIMEOUT
+    )
 
 
@@ -1,8 +1,8 @@
 from sqlalchemy import (
     Column, Integer, String, Boolean, DateTime,
-    ForeignKey, Float, Nullable, Table, Sequence
+    ForeignKey, Float, Nullable, Table, Sequence, Index, false, text
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, JSONB
 import uuid
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -11,6 +11,14 @@ import enum
 from app.database import Base
 
 
+def pg_trgm_installed(ddl, target, bind, **kw) -> bool:
+    """
+    Les index trigrammes ne sont créés que si l'extension pg_trgm est installée dans la base
+    (init_db.py tente de l'installer ; sinon create_all réussit sans eux).
+    """
+    return bind.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+
+
 class UserRole(str, enum.Enum):
     ADMIN = "admin"
     ETUDIANT = "etudiant"
@@ -53,6 +61,18 @@ class User(Base):
 
     # niveau = relationship("Niveau", back_populates="user")
 
+    __table_args__ = (
+        # Index GIN trigrammes pour le search_term (ILIKE '%terme%' et similarity()), si pg_trgm est installée
+        Index("ix_users_nom_trgm", "nom", postgresql_using="gin", postgresql_ops={"nom": "gin_trgm_ops"})
+        .ddl_if(callable_=pg_trgm_installed),
+        Index("ix_users_prenom_trgm", "prenom", postgresql_using="gin", postgresql_ops={"prenom": "gin_trgm_ops"})
+        .ddl_if(callable_=pg_trgm_installed),
+        Index("ix_users_matricule_trgm", "matricule", postgresql_using="gin", postgresql_ops={"matricule": "gin_trgm_ops"})
+        .ddl_if(callable_=pg_trgm_installed),
+        # Listes filtrées par rôle / statut (inscriptions en attente, destinataires des notifications)
+        Index("ix_users_type_is_active", "type", "is_active"),
+    )
+
     @hybrid_property
     def full_name(self):
         """Retourne le nom complet (nom + prénom)"""
@@ -182,6 +202,16 @@ class Document(Base):
     notifications = relationship("Notification", back_populates="document")
     infosupps = relationship("Infosupp", back_populates="document")
 
+    __table_args__ = (
+        # Listes triées par (date_de_demande DESC, id DESC) : tri et pagination par curseur sans Sort
+        Index("ix_document_date_de_demande_id", date_de_demande.desc(), id.desc()),
+        # Demandes d'un étudiant, les plus récentes d'abord
+        Index("ix_document_user_id_date_de_demande", user_id, date_de_demande.desc(), id.desc()),
+        # Filtres par statut et par catégorie (listes admin, statistiques)
+        Index("ix_document_status_date_de_demande", status, date_de_demande.desc()),
+        Index("ix_document_categorie_id", categorie_id),
+    )
+
     @hybrid_property
     def document_type(self):
         """Retourne le type de document (designation de la catégorie)"""
@@ -196,7 +226,8 @@ class Infosupp(Base):
     annee_univ = Column(String(20), nullable=True)
 
     # Relationship
-    document_id = Column(Integer, ForeignKey("document.id"), nullable=True)
+    # Indexé : selectinload(Document.infosupps) filtre sur document_id IN (...)
+    document_id = Column(Integer, ForeignKey("document.id"), nullable=True, index=True)
     document = relationship("Document", back_populates="infosupps")
 
 
@@ -220,6 +251,61 @@ class Notification(Base):
     user = relationship("User", back_populates="notifications")
     document = relationship("Document", back_populates="notifications")
 
+    __table_args__ = (
+        # Boîte de réception d'un utilisateur (lues / non lues), les plus récentes d'abord
+        Index("ix_notification_user_id_vue_date", user_id, vue, date_de_notification.desc()),
+        # Compteur de non lues : index partiel, ne contient que les lignes vue = false
+        Index("ix_notification_user_id_unread", user_id, postgresql_where=(vue == false())),
+    )
+
+
+class UserCounter(Base):
+    """
+    Compteurs d'un utilisateur (badges) : notifications non lues et demandes non supprimées par statut.
+    Tenus à jour dans la même transaction que les données (app/services/user_counters.py)
+    et réparés périodiquement par la réconciliation.
+    """
+    __tablename__ = "user_counter"
+
+    user_id = Column(UUID, ForeignKey("users.id"), primary_key=True)
+    unread_notifications = Column(Integer, default=0, server_default="0", nullable=False)
+    documents_pending = Column(Integer, default=0, server_default="0", nullable=False)
+    documents_validate = Column(Integer, default=0, server_default="0", nullable=False)
+    documents_refuse = Column(Integer, default=0, server_default="0", nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class OutboxKind(str, enum.Enum):
+    ABLY = "ably"
+    EMAIL = "email"
+    WEBSOCKET = "websocket"
+
+
+class OutboxStatus(str, enum.Enum):
+    PENDING = "pending"
+    PROCESSING = "processing"  # réservé par un worker jusqu'à available_at (bail)
+    SENT = "sent"
+    FAILED = "failed"
+
+
+class Outbox(Base):
+    """Effets de bord (Ably, email, WebSocket) écrits dans la même transaction que les données"""
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)  # ably/email/websocket
+    payload = Column(JSONB, nullable=False)
+    status = Column(String, default=OutboxStatus.PENDING.value, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(String, nullable=True)
+    available_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index("ix_outbox_status_available_at", "status", "available_at"),
+    )
+
 
 ############### Extra relationship to avoid mapping error from creating elements before other
 User.niveau = relationship("Niveau", back_populates="users")
@@ -1,12 +1,15 @@
-from pydantic import BaseModel, EmailStr, UUID4, Field, ConfigDict
+from pydantic import BaseModel, EmailStr, UUID4, Field, ConfigDict, create_model
 from datetime import datetime, date
-from typing import Optional, List
+from functools import lru_cache
+from typing import Dict, Optional, List, Literal, Tuple, Type
 
 class PaginationMeta(BaseModel):
-    page: int
-    page_total: int
+    page: Optional[int] = None  # None en mode curseur
+    page_total: Optional[int] = None  # None si le comptage n'est pas exact (estimé ou désactivé)
     per_page: int
-    total_items: int
+    total_items: Optional[int] = None  # Exact, estimé ou None selon `count`
+    total_is_estimate: bool = False  # True si total_items vient de l'estimation du planificateur
+    next_cursor: Optional[str] = None  # Mode curseur : curseur opaque de la page suivante
 
 # Schémas pour User
 class UserBase(BaseModel):
@@ -37,6 +40,10 @@ class UserRequestFilter(BaseModel):
     per_page: int = Field(10, ge=1, le=100, description="Nombre d'éléments par page (entre 1 et 100).")
     all: bool = Field(False, description="Si True, ignore la pagination et retourne tous les résultats (admin seulement).")
 
+    # --- Sparse fieldsets ---
+    fields: Optional[str] = Field(None, description="Champs à retourner, séparés par des virgules (ex: id,nom,prenom,email). Absent : tous.")
+    include: Optional[str] = Field(None, description="Relations à inclure (niveau). Avec `fields`, aucune par défaut.")
+
 class NiveauSchema(BaseModel):
     id:int
     designation: str
@@ -90,6 +97,20 @@ class TokenData(BaseModel):
     email: Optional[str] = None
 
 
+class Principal(BaseModel):
+    """Utilisateur authentifié, réduit aux champs utilisés par les contrôles d'accès (mis en cache)"""
+    id: UUID4
+    type: str
+    is_active: bool
+
+    model_config = ConfigDict(from_attributes=True, frozen=True)
+
+    @property
+    def role(self) -> str:
+        """Alias de type (compatibilité avec User.role)"""
+        return self.type
+
+
 # Schémas pour Document (alias pour compatibilité)
 class DocumentRequestBase(BaseModel):
     # document_type: List[str]
@@ -174,6 +195,16 @@ class DocumentRequestFilter(BaseModel):
     per_page: int = Field(10, ge=1, le=100, description="Nombre d'éléments par page (entre 1 et 100).")
     all: bool = Field(False, description="Si True, ignore la pagination et retourne tous les résultats (admin seulement).")
 
+    # --- Pagination par curseur (keyset sur date_de_demande, id) ---
+    mode: Literal["offset", "cursor"] = Field("offset", description="'offset' (page/per_page) ou 'cursor' (coût constant quelle que soit la profondeur).")
+    cursor: Optional[str] = Field(None, description="Mode curseur : valeur next_cursor de la page précédente (absent pour la première page).")
+    count: Literal["exact", "approximate", "none"] = Field("exact", description="Calcul de total_items : COUNT exact, estimation du planificateur, ou aucun.")
+
+    # --- Sparse fieldsets (listes uniquement, ignorés par l'export) ---
+    fields: Optional[str] = Field(None, description="Champs à retourner, séparés par des virgules (ex: id,numero,status,date_de_demande). Absent : tous.")
+    include: Optional[str] = Field(None, description="Relations à inclure : user, categorie, infosupps. Avec `fields`, aucune par défaut.")
+    compact: bool = Field(False, description="Si True, users et categories sont émis une seule fois dans `included` (clé : id) et les lignes les référencent par user_id / categorie_id.")
+
 
 class DocumentRequestResponse(DocumentRequestBase):
     id: int
@@ -200,6 +231,36 @@ class PaginatedDocumentRequestResponse(BaseModel):
     data: List[DocumentRequestResponse]
     pagination: PaginationMeta
 
+
+# Mode compact : les relations partagées sont émises une fois, les lignes les référencent par id
+class CompactDocumentRequestResponse(DocumentRequestBase):
+    id: int
+    user_id: UUID4
+    categorie_id: int
+    numero: Optional[int] = None
+    date_de_demande: datetime
+    date_de_validation: Optional[datetime] = None
+    pere: Optional[str] = None
+    mere: Optional[str] = None
+    status: str
+    est_paye: bool
+    is_deleted: bool
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    infosupps: Optional[List[InfoSuppSchema]] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+class IncludedEntities(BaseModel):
+    """Entités référencées par les lignes, une seule fois chacune (clé : id)"""
+    users: Dict[UUID4, UserResponse] = {}
+    categories: Dict[int, CategoriResponseSchema] = {}
+
+class CompactPaginatedDocumentRequestResponse(BaseModel):
+    data: List[CompactDocumentRequestResponse]
+    included: IncludedEntities
+    pagination: PaginationMeta
+
 class DocumentRequestUpdate(BaseModel):
     status: Optional[str] = None # pending, validate, refused
     est_paye: Optional[bool] = None
@@ -251,6 +312,13 @@ class NotificationResponseSchema(BaseModel):
 class NotificationSeenSchema(BaseModel):
     notif_ids: List[int]
 
+class UserCountersResponse(BaseModel):
+    """Badges : notifications non lues et demandes (non supprimées) par statut"""
+    unread_notifications: int = 0
+    documents_pending: int = 0
+    documents_validate: int = 0
+    documents_refuse: int = 0
+
 class EmailSchema(BaseModel):
     receivers: List[EmailStr]
     subject: str
@@ -277,3 +345,35 @@ class CategorieMinorUpdateSchema(BaseModel):
     designation : Optional[str] = None
     montant: Optional[float] = None
     contenu_notif: Optional[str] = None
+
+
+# ==================== SPARSE FIELDSETS ====================
+@lru_cache(maxsize=128)
+def sparse_model(model: Type[BaseModel], names: Tuple[str, ...]) -> Type[BaseModel]:
+    """Copie de `model` réduite aux champs demandés (mêmes types et validations), une classe par combinaison"""
+    return create_model(
+        f"{model.__name__}Sparse",
+        __config__=ConfigDict(from_attributes=True),
+        **{name: (model.model_fields[name].annotation, model.model_fields[name]) for name in names}
+    )
+
+
+@lru_cache(maxsize=128)
+def sparse_page_model(model: Type[BaseModel], names: Tuple[str, ...]) -> Type[BaseModel]:
+    """Enveloppe paginée {data, pagination} des lignes réduites"""
+    return create_model(
+        f"Paginated{model.__name__}Sparse",
+        data=(List[sparse_model(model, names)], ...),
+        pagination=(PaginationMeta, ...),
+    )
+
+
+@lru_cache(maxsize=128)
+def sparse_compact_page_model(names: Tuple[str, ...]) -> Type[BaseModel]:
+    """Enveloppe compacte {data, included, pagination} des lignes réduites"""
+    return create_model(
+        "CompactPaginatedDocumentRequestResponseSparse",
+        data=(List[sparse_model(CompactDocumentRequestResponse, names)], ...),
+        included=(IncludedEntities, ...),
+        pagination=(PaginationMeta, ...),
+    )
@@ -1,35 +1,229 @@
-from ably import AblyRealtime
+import asyncio
 import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from ably import AblyRest
+from ably.types.message import Message
 from dotenv import load_dotenv
-from fastapi import HTTPException
 from fastapi.encoders import jsonable_encoder
-import asyncio
-import json
 
 from ..schemas import AblyMessage
+from .websocket_manager import manager
 
 load_dotenv()
 ABLY_API_KEY = os.getenv("ABLY_API_KEY")
-ably_client = AblyRealtime(ABLY_API_KEY, client_id="my-first-client")
+ABLY_CLIENT_ID = os.getenv("ABLY_CLIENT_ID", "my-first-client")
+# ably = service Ably ; websocket = livraison via nos propres WebSockets ; noop = rien (tests, hors ligne)
+ABLY_TRANSPORT = os.getenv("ABLY_TRANSPORT", "ably").lower()
+# Fenêtre de regroupement des messages d'un même canal (secondes)
+ABLY_BATCH_WINDOW = float(os.getenv("ABLY_BATCH_WINDOW", "0.05"))
+ABLY_BATCH_MAX = int(os.getenv("ABLY_BATCH_MAX", "50"))
+ABLY_MAX_CONCURRENCY = int(os.getenv("ABLY_MAX_CONCURRENCY", "4"))
+ABLY_MAX_ATTEMPTS = int(os.getenv("ABLY_MAX_ATTEMPTS", "3"))
+ABLY_RETRY_BACKOFF = float(os.getenv("ABLY_RETRY_BACKOFF", "0.5"))
+
+# (publisher, payload) : un message Ably
+PendingMessage = Tuple[str, Any]
+
+
+class AblyPublishError(RuntimeError):
+    """Échec de publication d'un message (traduit en réponse HTTP par l'appelant)"""
+
+
+# ==================== TRANSPORTS ====================
+class AblyTransport:
+    """Publication via l'API REST d'Ably ; le client n'est créé qu'au premier envoi"""
+
+    def __init__(self, api_key: Optional[str] = ABLY_API_KEY, client_id: str = ABLY_CLIENT_ID):
+        self.api_key = api_key
+        self.client_id = client_id
+        self._client: Optional[AblyRest] = None
+
+    @property
+    def client(self) -> AblyRest:
+        if self._client is None:
+            if not self.api_key:
+                raise RuntimeError("ABLY_API_KEY is not configured")
+            self._client = AblyRest(self.api_key, client_id=self.client_id)
+        return self._client
+
+    async def publish_batch(self, channel_name: str, messages: List[PendingMessage]):
+        channel = self.client.channels.get(channel_name)
+        await channel.publish(messages=[Message(name=name, data=data) for name, data in messages])
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class WebSocketTransport:
+    """
+    Remplace Ably par nos WebSockets : admin_sco -> admins/scolarité, client-<id> -> l'utilisateur.
+    Utile pour un déploiement hors ligne ou sans compte Ably.
+    """
+
+    async def publish_batch(self, channel_name: str, messages: List[PendingMessage]):
+        for name, data in messages:
+            message = {"type": name, "channel": channel_name, "data": data}
+            if channel_name.startswith("client-"):
+                await manager.send_personal_message(message, channel_name.removeprefix("client-"))
+            elif channel_name.startswith("admin"):
+                await manager.broadcast_to_admins(message)
+            else:
+                print(f"Canal '{channel_name}' sans équivalent WebSocket, message ignoré")
+
+    async def close(self):
+        pass
+
+
+class NoopTransport:
+    """N'envoie rien ; garde les lots publiés pour les tests"""
+
+    def __init__(self):
+        self.published: List[Tuple[str, List[PendingMessage]]] = []
+
+    async def publish_batch(self, channel_name: str, messages: List[PendingMessage]):
+        self.published.append((channel_name, list(messages)))
+
+    async def close(self):
+        pass
+
+
+def create_transport(kind: str = ABLY_TRANSPORT):
+    if kind == "ably":
+        return AblyTransport()
+    if kind == "websocket":
+        return WebSocketTransport()
+    if kind == "noop":
+        return NoopTransport()
+    raise ValueError(f"Unknown Ably transport '{kind}'")
+
+
+# ==================== PUBLISHER ====================
+class AblyPublisher:
+    """
+    Worker (un par processus) qui regroupe les messages par canal pendant une courte fenêtre
+    et les publie en un seul appel, avec un nombre borné de publications simultanées.
+    """
+
+    def __init__(
+            self,
+            transport=None,
+            batch_window: float = ABLY_BATCH_WINDOW,
+            batch_max: int = ABLY_BATCH_MAX,
+            max_concurrency: int = ABLY_MAX_CONCURRENCY,
+            max_attempts: int = ABLY_MAX_ATTEMPTS,
+            retry_backoff: float = ABLY_RETRY_BACKOFF,
+    ):
+        self.transport = transport if transport is not None else create_transport()
+        self.batch_window = batch_window
+        self.batch_max = batch_max
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._inflight: set = set()
+
+    async def publish(self, channel_name: str, publisher: str, payload, wait: bool = True):
+        """Met le message en file ; avec wait=True, attend la publication (et lève l'erreur finale)"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((channel_name, publisher, payload, future))
+        if wait:
+            await future
+
+    async def _publish_channel(self, channel_name: str, items: List[Tuple[str, Any, asyncio.Future]]):
+        messages = [(name, data) for name, data, _ in items]
+        error = None
+        async with self._slots:
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    await self.transport.publish_batch(channel_name, messages)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if attempt < self.max_attempts:
+                        print(f"Publication Ably sur '{channel_name}' échouée (tentative {attempt}/{self.max_attempts}) : {e}")
+                        await asyncio.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+
+        for _, _, future in items:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    async def _next_batch(self) -> Dict[str, List[Tuple[str, Any, asyncio.Future]]]:
+        loop = asyncio.get_running_loop()
+        first = await self._queue.get()
+        batch = [first]
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.batch_max:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        by_channel: Dict[str, List[Tuple[str, Any, asyncio.Future]]] = {}
+        for channel_name, publisher, payload, future in batch:
+            by_channel.setdefault(channel_name, []).append((publisher, payload, future))
+        return by_channel
+
+    async def _run(self):
+        while True:
+            by_channel = await self._next_batch()
+            # Les canaux partent en parallèle (bornés par le sémaphore), le worker passe au lot suivant
+            for channel_name, items in by_channel.items():
+                task = asyncio.create_task(self._publish_channel(channel_name, items))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # On laisse finir les publications déjà lancées
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            *_, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Ably publisher stopped"))
+        await self.transport.close()
+
+
+# Instance globale du publisher
+ably_publisher = AblyPublisher()
+
+
+async def publish(channel_name: str, publisher: str, payload):
+    """Publie un payload déjà sérialisable (lève l'exception d'Ably en cas d'échec)"""
+    await ably_publisher.publish(channel_name, publisher, payload)
+
 
 async def send_message(msg: AblyMessage,):
     try:
-        channel = ably_client.channels.get(msg.channel)
-        print("Before publish")
-
-        # Convertir le contenu en JSON avant envoi
-        # content = (
-        #     msg.content.model_dump() if hasattr(msg.content, "model_dump") else msg.content
-        # )
-        payload = jsonable_encoder(msg.content)
-        print(payload)
         # Ably attend un texte ou un objet dict JSON-sérialisable
-        # await channel.publish(msg.publisher, json.dumps(content))
-        await channel.publish(msg.publisher, payload)
-
-        # await channel.publish(msg.publisher, msg.content)
-        # await asyncio.to_thread(channel.publish, msg.publisher, msg.content)
-        print("Ably send successfully")
+        await publish(msg.channel, msg.publisher, jsonable_encoder(msg.content))
     except Exception as e:
-        print(f"Error : {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        print(f"Erreur de publication Ably : {e}")
+        raise AblyPublishError(str(e)) from e
@@ -0,0 +1,166 @@
+import abc
+import asyncio
+import json
+import os
+from typing import Awaitable, Callable, Optional, Set
+
+import asyncpg
+from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
+
+from ..database import ASYNC_DATABASE_URL
+
+load_dotenv()
+
+# local = un seul processus ; postgres = diffusion entre workers/hôtes via LISTEN/NOTIFY
+WEBSOCKET_BACKPLANE = os.getenv("WEBSOCKET_BACKPLANE", "local").lower()
+WEBSOCKET_NOTIFY_CHANNEL = os.getenv("WEBSOCKET_NOTIFY_CHANNEL", "websocket_events")
+WEBSOCKET_RECONNECT_SECONDS = float(os.getenv("WEBSOCKET_RECONNECT_SECONDS", "2.0"))
+
+# Limite PostgreSQL d'un payload NOTIFY (8000 octets, on garde une marge)
+NOTIFY_MAX_PAYLOAD = 7900
+
+Deliver = Callable[[dict], Awaitable[None]]
+
+
+class Backplane(abc.ABC):
+    """
+    Canal de diffusion entre processus. Le manager publie une enveloppe,
+    chaque processus abonné la reçoit et la livre à ses propres sockets.
+    """
+
+    @abc.abstractmethod
+    async def start(self, deliver: Deliver):
+        ...
+
+    @abc.abstractmethod
+    async def publish(self, envelope: dict):
+        ...
+
+    async def stop(self):
+        pass
+
+
+class LocalBackplane(Backplane):
+    """Pas de diffusion : livraison directe dans le processus courant"""
+
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+
+    async def publish(self, envelope: dict):
+        if self._deliver is not None:
+            await self._deliver(envelope)
+
+
+class PostgresBackplane(Backplane):
+    """
+    Diffusion via LISTEN/NOTIFY : une connexion asyncpg dédiée par processus écoute le canal,
+    une seconde (ouverte à la demande, réutilisée) envoie les NOTIFY en autocommit sans
+    emprunter le pool. Le processus émetteur reçoit aussi sa propre notification :
+    il ne livre donc jamais en direct (pas de doublon).
+    """
+
+    def __init__(self, channel: str = WEBSOCKET_NOTIFY_CHANNEL, reconnect_seconds: float = WEBSOCKET_RECONNECT_SECONDS):
+        self.channel = channel
+        self.reconnect_seconds = reconnect_seconds
+        self.dsn = make_url(ASYNC_DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+        self._deliver: Optional[Deliver] = None
+        self._task: Optional[asyncio.Task] = None
+        self._connection: Optional[asyncpg.Connection] = None
+        self._publish_connection: Optional[asyncpg.Connection] = None
+        # asyncpg n'exécute qu'une requête à la fois par connexion
+        self._publish_lock = asyncio.Lock()
+        # Références des livraisons en cours (sinon les tâches peuvent être collectées)
+        self._deliveries: Set[asyncio.Task] = set()
+
+    def _on_notification(self, connection, pid, channel, payload: str):
+        try:
+            envelope = json.loads(payload)
+        except ValueError:
+            print(f"Notification WebSocket illisible ignorée : {payload[:200]}")
+            return
+        if self._deliver is None:
+            return
+        task = asyncio.get_running_loop().create_task(self._deliver(envelope))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _listen(self):
+        """Maintient l'abonnement ; se reconnecte si la connexion tombe"""
+        while True:
+            lost = asyncio.Event()
+            try:
+                self._connection = await asyncpg.connect(self.dsn)
+                self._connection.add_termination_listener(lambda connection: lost.set())
+                await self._connection.add_listener(self.channel, self._on_notification)
+                await lost.wait()
+                print("Connexion LISTEN WebSocket perdue, reconnexion...")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Impossible d'écouter le canal '{self.channel}' : {e}")
+            finally:
+                await self._close_connection()
+            await asyncio.sleep(self.reconnect_seconds)
+
+    @staticmethod
+    async def _close(connection: Optional[asyncpg.Connection]):
+        if connection is not None and not connection.is_closed():
+            try:
+                await connection.close()
+            except Exception:
+                connection.terminate()
+
+    async def _close_connection(self):
+        connection, self._connection = self._connection, None
+        await self._close(connection)
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._listen())
+
+    async def publish(self, envelope: dict):
+        payload = json.dumps(envelope, separators=(",", ":"), default=str)
+        if len(payload.encode("utf-8")) > NOTIFY_MAX_PAYLOAD:
+            # Trop gros pour NOTIFY : on ne peut atteindre que les sockets de ce processus
+            print(f"Message WebSocket trop volumineux pour NOTIFY ({len(payload)} octets), livraison locale uniquement")
+            if self._deliver is not None:
+                await self._deliver(envelope)
+            return
+
+        async with self._publish_lock:
+            try:
+                if self._publish_connection is None or self._publish_connection.is_closed():
+                    self._publish_connection = await asyncpg.connect(self.dsn)
+                # Hors transaction explicite : asyncpg est en autocommit, le NOTIFY part aussitôt
+                await self._publish_connection.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+            except Exception:
+                # Connexion inutilisable : on la referme, la prochaine publication en rouvrira une
+                connection, self._publish_connection = self._publish_connection, None
+                await self._close(connection)
+                raise
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._close_connection()
+        async with self._publish_lock:
+            connection, self._publish_connection = self._publish_connection, None
+            await self._close(connection)
+
+
+def create_backplane(kind: str = WEBSOCKET_BACKPLANE) -> Backplane:
+    if kind == "postgres":
+        return PostgresBackplane()
+    if kind == "local":
+        return LocalBackplane()
+    raise ValueError(f"Unknown websocket backplane '{kind}'")
@@ -0,0 +1,56 @@
+import csv
+import io
+from typing import AsyncIterator, List
+
+from ..models import Document
+from ..schemas import DocumentRequestResponse
+
+# Colonnes de l'export CSV (une ligne par demande, relations aplaties)
+CSV_COLUMNS = [
+    "id", "numero", "date_de_demande", "date_de_validation", "status", "est_paye",
+    "categorie", "montant", "matricule", "nom", "prenom", "email", "pere", "mere",
+]
+
+
+def _csv_row(document: Document) -> list:
+    user = document.user
+    categorie = document.categorie
+    return [
+        document.id,
+        document.numero,
+        document.date_de_demande.isoformat() if document.date_de_demande else "",
+        document.date_de_validation.isoformat() if document.date_de_validation else "",
+        document.status,
+        document.est_paye,
+        categorie.designation if categorie else "",
+        categorie.montant if categorie else "",
+        user.matricule if user else "",
+        user.nom if user else "",
+        user.prenom if user else "",
+        user.email if user else "",
+        document.pere or "",
+        document.mere or "",
+    ]
+
+
+async def iter_ndjson(partitions: AsyncIterator[List[Document]]) -> AsyncIterator[str]:
+    """Une ligne JSON (même forme que DocumentRequestResponse) par demande"""
+    async for partition in partitions:
+        yield "".join(
+            DocumentRequestResponse.model_validate(document).model_dump_json() + "\n"
+            for document in partition
+        )
+
+
+async def iter_csv(partitions: AsyncIterator[List[Document]]) -> AsyncIterator[str]:
+    """En-tête puis une ligne CSV par demande, émises lot par lot"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    yield buffer.getvalue()
+
+    async for partition in partitions:
+        buffer.seek(0)
+        buffer.truncate(0)
+        writer.writerows(_csv_row(document) for document in partition)
+        yield buffer.getvalue()
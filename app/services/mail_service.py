@@ -1,9 +1,16 @@
+import asyncio
 import os
-from typing import Optional
+import re
+from functools import lru_cache
+from email.message import EmailMessage
+from email.utils import formataddr, formatdate, make_msgid
+from string import Template
+from typing import Dict, List, Optional, Tuple
 from..schemas import EmailSchema
 from ..models import TypeNotif, Document
 from fastapi import BackgroundTasks
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
+import aiosmtplib
+from fastapi_mail import MessageSchema, ConnectionConfig, MessageType
 from pydantic import BaseModel, EmailStr
 from pathlib import Path
 from dotenv import load_dotenv
@@ -11,73 +18,375 @@ load_dotenv()
 
 BASE_DIR = Path(__file__).parent
 
-conf = ConnectionConfig(
-    MAIL_USERNAME=os.getenv("SMTP_USER"),
-    MAIL_PASSWORD=os.getenv("SMTP_PASS"),
-    MAIL_FROM=os.getenv("SMTP_FROM"),
-    MAIL_PORT=os.getenv("SMTP_PORT"),
-    MAIL_SERVER=os.getenv("SMTP_HOST"),
-    MAIL_STARTTLS=True,
-    MAIL_SSL_TLS=False,
-    USE_CREDENTIALS=True,
-    VALIDATE_CERTS=True
-)
 
-async def send_email_async(
-        email_data: EmailSchema,
-        background_tasks: BackgroundTasks,
-        type_notif: TypeNotif,
-        document: Document = None
-):
-    """
-    Crée le message en utilisant un template HTML externe, le personnalise 
-    et l'ajoute aux BackgroundTasks pour un envoi asynchrone.
-    """
-    template_path = BASE_DIR / "template_email.html"
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+@lru_cache(maxsize=1)
+def get_mail_config() -> ConnectionConfig:
+    """Configuration SMTP construite (et validée) au premier envoi, pas à l'import"""
+    return ConnectionConfig(
+        MAIL_USERNAME=os.getenv("SMTP_USER"),
+        MAIL_PASSWORD=os.getenv("SMTP_PASS"),
+        MAIL_FROM=os.getenv("SMTP_FROM"),
+        MAIL_PORT=os.getenv("SMTP_PORT"),
+        MAIL_SERVER=os.getenv("SMTP_HOST"),
+        # Surchargeables pour pointer vers un serveur SMTP local de test (aiosmtpd) sans TLS ni authentification
+        MAIL_STARTTLS=_env_flag("SMTP_STARTTLS", "true"),
+        MAIL_SSL_TLS=_env_flag("SMTP_SSL_TLS", "false"),
+        USE_CREDENTIALS=_env_flag("SMTP_USE_CREDENTIALS", "true"),
+        VALIDATE_CERTS=_env_flag("SMTP_VALIDATE_CERTS", "true")
+    )
+
+# Fenêtre pendant laquelle le worker regroupe les messages avant d'envoyer (secondes)
+MAIL_BATCH_WINDOW = float(os.getenv("MAIL_BATCH_WINDOW", "0.5"))
+MAIL_BATCH_MAX = int(os.getenv("MAIL_BATCH_MAX", "100"))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "3"))
+MAIL_RETRY_BACKOFF = float(os.getenv("MAIL_RETRY_BACKOFF", "1.0"))
+# Ferme la connexion SMTP après N secondes sans message
+MAIL_IDLE_TIMEOUT = float(os.getenv("MAIL_IDLE_TIMEOUT", "60"))
+
+# En développement : recompile le template dès que le fichier change sur le disque
+MAIL_TEMPLATE_RELOAD = _env_flag("MAIL_TEMPLATE_RELOAD", "false")
+
+DEFAULT_TEMPLATE = "template_email.html"
+_PLACEHOLDER = re.compile(r"{{\s*(\w+)\s*}}")
+
+
+class CompiledTemplate:
+    """Template HTML lu une seule fois et converti en string.Template ({{ nom }} -> ${nom})"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.mtime = path.stat().st_mtime
+        source = path.read_text(encoding="utf-8")
+        self.template = Template(_PLACEHOLDER.sub(r"${\1}", source.replace("$", "$$")))
+
+    def render(self, **values) -> str:
+        return self.template.safe_substitute(**values)
 
-    if not os.path.exists(template_path):
-        print(f"ERREUR: Template file not found at: {template_path.resolve()}")
-        return
+
+# Un template par type de notification (template_email_<type>.html s'il existe, sinon le template commun)
+_templates: Dict[TypeNotif, CompiledTemplate] = {}
+
+
+def _template_path(type_notif: TypeNotif) -> Path:
+    specific = BASE_DIR / f"template_email_{type_notif.value}.html"
+    return specific if specific.exists() else BASE_DIR / DEFAULT_TEMPLATE
+
+
+def get_template(type_notif: TypeNotif) -> Optional[CompiledTemplate]:
+    """Retourne le template compilé du type, en le chargeant au premier appel"""
+    compiled = _templates.get(type_notif)
+    if compiled is not None and not MAIL_TEMPLATE_RELOAD:
+        return compiled
 
     try:
-        with open(template_path, "r", encoding="utf-8") as f:
-            html_template = f.read()
-    except IOError as e:
-        print(f"ERREUR: Impossible de lire le fichier template : {e}")
-        return
+        if compiled is not None and compiled.path.stat().st_mtime == compiled.mtime:
+            return compiled
+        compiled = CompiledTemplate(_template_path(type_notif))
+    except OSError as e:
+        print(f"ERREUR: Impossible de lire le template email ({type_notif.value}) : {e}")
+        return _templates.get(type_notif)
+
+    _templates[type_notif] = compiled
+    return compiled
 
-    type_text = ""
 
-    if type_notif.value == TypeNotif.REGISTER.value:
+def _type_text(type_notif: TypeNotif, numero: Optional[int], categorie: Optional[str]) -> str:
+    if type_notif == TypeNotif.REGISTER:
         # type_text = "Action Requise : Nouvelle Inscription en Attente de Validation"
-        type_text = f"Nouvelle inscription en attente de validation. Un nouvel utilisateur est en attente d'approbation administrative. "
-    elif type_notif.value == TypeNotif.REQUEST.value and document is not None:
-        # type_text = f"Demande Étudiante Reçue : {document.categorie.designation}"
-        type_text = f"Nouvelle demande de document à examiner (N°: {document.numero}, Categori : {document.categorie.designation})."
-    elif type_notif.value == TypeNotif.VALIDATION.value and document is not None:
-        # type_text = f"Votre Demande de Document (N°: {document.numero}) a été Validée"
-        type_text = f"Votre Demande de Document (N°: {document.numero}) a été Validée"
-    else :
-        type_text = f"Notification speci[Numéro_Document]fique."
-
-    html_template = html_template.replace("{{ sujet }}", type_text)
-    html_template = html_template.replace("{{ type_notif }}", type_text)
-    html_template = html_template.replace("{{ message }}", email_data.body)
-
-    message = MessageSchema(
+        return f"Nouvelle inscription en attente de validation. Un nouvel utilisateur est en attente d'approbation administrative. "
+    if type_notif == TypeNotif.REQUEST and numero is not None:
+        # type_text = f"Demande Étudiante Reçue : {categorie}"
+        return f"Nouvelle demande de document à examiner (N°: {numero}, Categori : {categorie})."
+    if type_notif == TypeNotif.VALIDATION and numero is not None:
+        # type_text = f"Votre Demande de Document (N°: {numero}) a été Validée"
+        return f"Votre Demande de Document (N°: {numero}) a été Validée"
+    return f"Notification speci[Numéro_Document]fique."
+
+
+def build_email_message(
+        email_data: EmailSchema,
+        type_notif: TypeNotif,
+        numero: Optional[int] = None,
+        categorie: Optional[str] = None
+) -> Optional[MessageSchema]:
+    """
+    Crée le message à partir du template HTML précompilé et le personnalise.
+    `numero` et `categorie` sont ceux du document concerné (si applicable).
+    """
+    template = get_template(type_notif)
+    if template is None:
+        return None
+
+    type_text = _type_text(type_notif, numero, categorie)
+    html = template.render(sujet=type_text, type_notif=type_text, message=email_data.body)
+
+    return MessageSchema(
         subject = email_data.subject,
         recipients = [*email_data.receivers],
-        body = html_template,
+        body = html,
         subtype = MessageType.html
     )
 
-    fm = FastMail(conf)
 
-    background_tasks.add_task(fm.send_message, message)
+# ==================== ENVOI SMTP GROUPÉ ====================
+# (message, future de l'appelant, nombre maximal de tentatives SMTP) : un message en file
+QueuedMessage = Tuple[MessageSchema, asyncio.Future, int]
+
+
+def _envelope(message: MessageSchema) -> List[str]:
+    """Destinataires SMTP (RCPT TO) d'un message : To, Cc et Bcc, sans doublon"""
+    recipients = []
+    for address in [*message.recipients, *message.cc, *message.bcc]:
+        # NameEmail (recipients) ou adresse simple
+        email = getattr(address, "email", address)
+        if email not in recipients:
+            recipients.append(email)
+    return recipients
+
+
+class MailSender:
+    """
+    Worker (un par processus) qui vide une file de messages sur une connexion SMTP persistante.
+    Les messages arrivés dans la même fenêtre sont envoyés ensemble, et les messages identiques
+    (même sujet, même contenu) sont fusionnés au niveau de l'enveloppe SMTP : un seul DATA pour
+    tous les destinataires, qui n'apparaissent pas dans les en-têtes (équivalent d'un Bcc).
+    """
+
+    def __init__(
+            self,
+            config: Optional[ConnectionConfig] = None,
+            batch_window: float = MAIL_BATCH_WINDOW,
+            batch_max: int = MAIL_BATCH_MAX,
+            max_attempts: int = MAIL_MAX_ATTEMPTS,
+            retry_backoff: float = MAIL_RETRY_BACKOFF,
+            idle_timeout: float = MAIL_IDLE_TIMEOUT,
+    ):
+        self._config = config
+        self.batch_window = batch_window
+        self.batch_max = batch_max
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.idle_timeout = idle_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._smtp: Optional[aiosmtplib.SMTP] = None
+
+    @property
+    def config(self) -> ConnectionConfig:
+        if self._config is None:
+            self._config = get_mail_config()
+        return self._config
+
+    async def send(self, message: MessageSchema, max_attempts: Optional[int] = None):
+        """
+        Met le message en file et attend son envoi effectif (lève l'erreur SMTP en cas d'échec).
+        max_attempts remplace self.max_attempts pour ce message (1 : l'appelant gère les reprises).
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((message, future, max_attempts or self.max_attempts))
+        await future
+
+    # ---------- connexion ----------
+    async def _connection(self) -> aiosmtplib.SMTP:
+        if self._smtp is not None and self._smtp.is_connected:
+            return self._smtp
+
+        smtp = aiosmtplib.SMTP(
+            hostname=self.config.MAIL_SERVER,
+            port=self.config.MAIL_PORT,
+            timeout=self.config.TIMEOUT,
+            use_tls=self.config.MAIL_SSL_TLS,
+            start_tls=self.config.MAIL_STARTTLS,
+            validate_certs=self.config.VALIDATE_CERTS,
+        )
+        await smtp.connect()
+        if self.config.USE_CREDENTIALS:
+            await smtp.login(self.config.MAIL_USERNAME, self.config.MAIL_PASSWORD.get_secret_value())
+        self._smtp = smtp
+        return smtp
+
+    async def _close(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is None or not smtp.is_connected:
+            return
+        try:
+            await smtp.quit()
+        except Exception:
+            smtp.close()
+
+    # ---------- regroupement ----------
+    @staticmethod
+    def _coalesce(batch: List[QueuedMessage]) -> List[Tuple[MessageSchema, List[str], List[asyncio.Future], int]]:
+        """
+        Regroupe les messages identiques : (message, destinataires de l'enveloppe, futures, tentatives).
+        Un envoi groupé fait le plus petit nombre de tentatives demandé par ses messages.
+        """
+        groups: Dict[object, Tuple[MessageSchema, List[str], List[asyncio.Future], int]] = {}
+        for message, future, max_attempts in batch:
+            if message.cc or message.bcc:
+                key = id(message)
+            else:
+                key = (message.subject, message.body, message.subtype, message.from_email, message.from_name)
+
+            if key not in groups:
+                groups[key] = (message, _envelope(message), [future], max_attempts)
+                continue
+
+            merged, recipients, futures, attempts = groups[key]
+            recipients += [r for r in _envelope(message) if r not in recipients]
+            futures.append(future)
+            groups[key] = (merged, recipients, futures, min(attempts, max_attempts))
+        return list(groups.values())
+
+    def _sender(self, message: MessageSchema) -> str:
+        sender = message.from_email or self.config.MAIL_FROM
+        from_name = message.from_name or self.config.MAIL_FROM_NAME
+        return formataddr((from_name, sender)) if from_name else sender
+
+    def _build_message(self, message: MessageSchema, recipients: List[str]) -> EmailMessage:
+        """
+        Message MIME construit ici (sans l'API privée de fastapi_mail). L'en-tête To ne liste
+        les destinataires que si l'envoi n'a pas été fusionné avec celui d'autres personnes.
+        """
+        if message.attachments:
+            raise ValueError("MailSender does not support attachments")
+
+        mime = EmailMessage()
+        mime["From"] = self._sender(message)
+        if recipients == _envelope(message):
+            mime["To"] = ", ".join(str(address) for address in message.recipients)
+            if message.cc:
+                mime["Cc"] = ", ".join(str(address) for address in message.cc)
+        else:
+            mime["To"] = "undisclosed-recipients:;"
+        if message.reply_to:
+            mime["Reply-To"] = ", ".join(str(address) for address in message.reply_to)
+        mime["Subject"] = message.subject
+        mime["Date"] = formatdate(localtime=True)
+        mime["Message-ID"] = make_msgid()
+        for name, value in (message.headers or {}).items():
+            mime[name] = value
+        mime.set_content(message.body or "", subtype="html" if message.subtype == MessageType.html else "plain")
+        return mime
+
+    async def _deliver(self, message: MessageSchema, recipients: List[str], max_attempts: int):
+        prepared = self._build_message(message, recipients)
+        if self.config.SUPPRESS_SEND:
+            return
+
+        for attempt in range(1, max_attempts + 1):
+            try:
+                smtp = await self._connection()
+                await smtp.send_message(prepared, recipients=recipients)
+                return
+            except (aiosmtplib.SMTPException, OSError) as e:
+                # Connexion probablement cassée : on repart d'une connexion neuve
+                await self._close()
+                if attempt >= max_attempts:
+                    raise
+                print(f"Envoi SMTP échoué (tentative {attempt}/{max_attempts}) : {e}")
+                await asyncio.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+
+    async def _send_batch(self, batch: List[QueuedMessage]):
+        for message, recipients, futures, max_attempts in self._coalesce(batch):
+            try:
+                await self._deliver(message, recipients, max_attempts)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in futures:
+                    if not future.done():
+                        future.set_result(None)
+
+    # ---------- worker ----------
+    async def _next_batch(self) -> List[QueuedMessage]:
+        loop = asyncio.get_running_loop()
+        batch = [await asyncio.wait_for(self._queue.get(), timeout=self.idle_timeout)]
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.batch_max:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            try:
+                batch = await self._next_batch()
+            except asyncio.TimeoutError:
+                await self._close()
+                continue
+            try:
+                await self._send_batch(batch)
+            except Exception as e:
+                print(f"Erreur du worker d'envoi des emails : {e}")
+
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # Les messages encore en file échouent : l'outbox les retentera au prochain démarrage
+        while self._queue is not None and not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Mail sender stopped"))
+        await self._close()
+
+
+# Instance globale de l'expéditeur
+mail_sender = MailSender()
+
+
+async def send_email_now(message: MessageSchema, max_attempts: Optional[int] = None):
+    """Envoie le message via le worker SMTP (utilisé par le dispatcher de l'outbox)"""
+    await mail_sender.send(message, max_attempts=max_attempts)
+
+
+async def send_email_async(
+        email_data: EmailSchema,
+        background_tasks: BackgroundTasks,
+        type_notif: TypeNotif,
+        document: Document = None
+):
+    """
+    Crée le message à partir du template HTML précompilé, le personnalise
+    et l'ajoute aux BackgroundTasks pour un envoi asynchrone.
+    """
+    message = build_email_message(
+        email_data,
+        type_notif,
+        numero=document.numero if document is not None else None,
+        categorie=document.categorie.designation if document is not None else None
+    )
+    if message is None:
+        return
+
+    background_tasks.add_task(mail_sender.send, message)
     # try:
     #     await fm.send_message(message)
     #     print(f"DEBUG: Email envoyé avec succès à {email_data.destinataire}")
     # except Exception as e:
     #     # Si vous voyez cette erreur, c'est que la configuration SMTP est fausse.
     #     print(f"ERREUR CRITIQUE D'ENVOI SMTP : {e}")
-
@@ -0,0 +1,43 @@
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Un échantillon : (labels, valeur)
+Sample = Tuple[Dict[str, str], float]
+# Une métrique : (nom, type prometheus, description, échantillons)
+Metric = Tuple[str, str, str, List[Sample]]
+
+
+class MetricsRegistry:
+    """
+    Registre minimal de métriques au format texte Prometheus.
+    Chaque module enregistre un collecteur qui lit ses valeurs au moment du scrape.
+    """
+
+    def __init__(self):
+        self._collectors: List[Callable[[], Iterable[Metric]]] = []
+
+    def register(self, collector: Callable[[], Iterable[Metric]]):
+        self._collectors.append(collector)
+        return collector
+
+    def collect(self) -> List[Metric]:
+        metrics = []
+        for collector in self._collectors:
+            metrics.extend(collector())
+        return metrics
+
+    def render(self) -> str:
+        lines = []
+        for name, metric_type, description, samples in self.collect():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                if labels:
+                    label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Instance globale du registre
+metrics_registry = MetricsRegistry()
@@ -0,0 +1,259 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..database import AsyncSessionLocal
+from ..models import Document, Outbox, OutboxKind, OutboxStatus, TypeNotif
+from ..schemas import AblyMessage, EmailSchema
+from .ably_service import publish
+from .mail_service import build_email_message, send_email_now
+from .websocket_manager import manager
+
+load_dotenv()
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_BACKOFF_SECONDS", "2.0"))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_MAX_BACKOFF_SECONDS", "300"))
+# Durée du bail d'un lot réservé : passé ce délai (worker mort), les lignes sont reprises
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+
+
+# ==================== ÉCRITURE (même transaction que les données) ====================
+def enqueue_ably_message(db: AsyncSession, msg: AblyMessage) -> Outbox:
+    """Ajoute une publication Ably à l'outbox (commit fait par l'appelant)"""
+    entry = Outbox(
+        kind=OutboxKind.ABLY.value,
+        payload={
+            "channel": msg.channel,
+            "publisher": msg.publisher,
+            "content": jsonable_encoder(msg.content),
+        },
+    )
+    db.add(entry)
+    return entry
+
+
+def enqueue_email(
+        db: AsyncSession,
+        email_data: EmailSchema,
+        type_notif: TypeNotif,
+        document: Optional[Document] = None
+) -> Outbox:
+    """Ajoute un email à l'outbox (commit fait par l'appelant)"""
+    entry = Outbox(
+        kind=OutboxKind.EMAIL.value,
+        payload={
+            "email": jsonable_encoder(email_data),
+            "type_notif": type_notif.value,
+            "numero": document.numero if document is not None else None,
+            "categorie": document.categorie.designation if document is not None else None,
+        },
+    )
+    db.add(entry)
+    return entry
+
+
+def enqueue_websocket_message(db: AsyncSession, user_id: str, message: dict) -> Outbox:
+    """Ajoute un message WebSocket personnel à l'outbox (commit fait par l'appelant)"""
+    entry = Outbox(
+        kind=OutboxKind.WEBSOCKET.value,
+        payload={"user_id": str(user_id), "message": jsonable_encoder(message)},
+    )
+    db.add(entry)
+    return entry
+
+
+# ==================== HANDLERS ====================
+async def _handle_ably(payload: dict):
+    await publish(payload["channel"], payload["publisher"], payload["content"])
+
+
+async def _handle_email(payload: dict):
+    message = build_email_message(
+        EmailSchema(**payload["email"]),
+        TypeNotif(payload["type_notif"]),
+        numero=payload.get("numero"),
+        categorie=payload.get("categorie"),
+    )
+    if message is None:
+        raise RuntimeError("Email template unavailable")
+    # Une seule tentative SMTP : les nouvelles tentatives (avec backoff) sont celles de l'outbox
+    await send_email_now(message, max_attempts=1)
+
+
+async def _handle_websocket(payload: dict):
+    await manager.send_personal_message(payload["message"], payload["user_id"])
+
+
+DEFAULT_HANDLERS: Dict[str, Callable[[dict], Awaitable[None]]] = {
+    OutboxKind.ABLY.value: _handle_ably,
+    OutboxKind.EMAIL.value: _handle_email,
+    OutboxKind.WEBSOCKET.value: _handle_websocket,
+}
+
+
+# ==================== DISPATCHER ====================
+class OutboxDispatcher:
+    """
+    Worker asynchrone (un par processus) qui vide l'outbox par lots, avec une file par type
+    de message : un serveur SMTP lent ne retarde pas les notifications temps réel.
+    Un lot est d'abord réservé (SKIP LOCKED, statut processing avec un bail) dans une
+    transaction courte : plusieurs workers uvicorn peuvent tourner en parallèle sans
+    envoyer deux fois le même message, et aucun verrou ni connexion n'est tenu pendant
+    les envois. Les résultats sont enregistrés dans une seconde transaction courte.
+    """
+
+    def __init__(
+            self,
+            session_factory=AsyncSessionLocal,
+            handlers: Optional[Dict[str, Callable[[dict], Awaitable[None]]]] = None,
+            batch_size: int = OUTBOX_BATCH_SIZE,
+            poll_interval: float = OUTBOX_POLL_INTERVAL,
+            max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+            backoff_seconds: float = OUTBOX_BACKOFF_SECONDS,
+            max_backoff_seconds: float = OUTBOX_MAX_BACKOFF_SECONDS,
+            lease_seconds: float = OUTBOX_LEASE_SECONDS,
+    ):
+        self.session_factory = session_factory
+        self.handlers = handlers if handlers is not None else dict(DEFAULT_HANDLERS)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.lease_seconds = lease_seconds
+        self._wakeups: Dict[str, asyncio.Event] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def wake(self):
+        """Réveille les files (appelé après un commit qui a écrit dans l'outbox)"""
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+
+    def _next_attempt_at(self, attempts: int) -> datetime:
+        delay = min(self.backoff_seconds * (2 ** (attempts - 1)), self.max_backoff_seconds)
+        return datetime.now(timezone.utc) + timedelta(seconds=delay)
+
+    async def _dispatch(self, kind: str, payload: dict):
+        handler = self.handlers.get(kind)
+        if handler is None:
+            raise RuntimeError(f"No outbox handler for kind '{kind}'")
+        await handler(payload)
+
+    async def _claim(self, kind: Optional[str] = None) -> List[Tuple[int, str, dict, int]]:
+        """
+        Réserve un lot (d'un type, ou de tous si kind est None) : lignes en attente,
+        ou en cours dont le bail a expiré (worker mort).
+        Chaque réservation compte comme une tentative, pour qu'un message qui fait tomber
+        le worker finisse en échec au lieu d'être repris indéfiniment.
+        """
+        now = datetime.now(timezone.utc)
+        async with self.session_factory() as db:
+            stmt = (
+                select(Outbox)
+                .where(
+                    Outbox.status.in_([OutboxStatus.PENDING.value, OutboxStatus.PROCESSING.value]),
+                    Outbox.available_at <= now,
+                )
+                .order_by(Outbox.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            if kind is not None:
+                stmt = stmt.where(Outbox.kind == kind)
+            entries = (await db.execute(stmt)).scalars().all()
+            claimed = []
+            for entry in entries:
+                entry.status = OutboxStatus.PROCESSING.value
+                entry.available_at = now + timedelta(seconds=self.lease_seconds)
+                entry.attempts += 1
+                claimed.append((entry.id, entry.kind, entry.payload, entry.attempts))
+            await db.commit()
+        return claimed
+
+    async def run_once(self, kind: Optional[str] = None) -> int:
+        """Traite un lot de messages en attente (d'un type, ou de tous). Retourne le nombre de lignes traitées."""
+        claimed = await self._claim(kind)
+        if not claimed:
+            return 0
+
+        # Envois hors transaction : aucune connexion du pool n'est tenue pendant SMTP/Ably
+        results = await asyncio.gather(
+            *(self._dispatch(kind, payload) for _, kind, payload, _ in claimed),
+            return_exceptions=True
+        )
+
+        async with self.session_factory() as db:
+            for (entry_id, kind, _, attempts), result in zip(claimed, results):
+                if isinstance(result, BaseException):
+                    values = {"last_error": str(result)[:1000]}
+                    if attempts >= self.max_attempts:
+                        values["status"] = OutboxStatus.FAILED.value
+                        print(f"Outbox {entry_id} ({kind}) abandonné après {attempts} tentatives : {result}")
+                    else:
+                        values["status"] = OutboxStatus.PENDING.value
+                        values["available_at"] = self._next_attempt_at(attempts)
+                else:
+                    values = {"status": OutboxStatus.SENT.value, "sent_at": datetime.now(timezone.utc)}
+
+                # Bail expiré et ligne reprise par un autre worker : c'est lui qui conclura
+                await db.execute(
+                    update(Outbox)
+                    .where(
+                        Outbox.id == entry_id,
+                        Outbox.status == OutboxStatus.PROCESSING.value,
+                        Outbox.attempts == attempts,
+                    )
+                    .values(**values)
+                )
+            await db.commit()
+        return len(claimed)
+
+    async def _run(self, kind: str):
+        wakeup = self._wakeups[kind]
+        while True:
+            try:
+                processed = await self.run_once(kind)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Erreur du dispatcher outbox ({kind}) : {e}")
+                processed = 0
+
+            # Lot plein : on enchaîne directement, sinon on attend un réveil ou le polling
+            if processed >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+    def start(self):
+        for kind in self.handlers:
+            self._wakeups.setdefault(kind, asyncio.Event())
+            task = self._tasks.get(kind)
+            if task is None or task.done():
+                self._tasks[kind] = asyncio.create_task(self._run(kind))
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, {}
+        for task in tasks.values():
+            task.cancel()
+        for task in tasks.values():
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+# Instance globale du dispatcher
+outbox_dispatcher = OutboxDispatcher()
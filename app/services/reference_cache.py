@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+load_dotenv()
+
+# Durée de vie d'une entrée : borne le décalage entre workers (l'invalidation est locale au processus)
+REFERENCE_CACHE_TTL = float(os.getenv("REFERENCE_CACHE_TTL", "300"))
+# max-age envoyé aux clients ; 0 = revalidation systématique via ETag (réponse 304 quasi gratuite)
+REFERENCE_CACHE_MAX_AGE = int(os.getenv("REFERENCE_CACHE_MAX_AGE", "0"))
+
+
+class CachedReference:
+    """Liste de référence déjà sérialisée, avec son ETag"""
+
+    def __init__(self, items: List[dict], expire_at: float):
+        self.items = items
+        self.by_id = {item["id"]: item for item in items}
+        self.body = json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.etag = f'"{hashlib.sha1(self.body).hexdigest()}"'
+        self.expire_at = expire_at
+
+
+class ReferenceDataCache:
+    """Cache processus des tables de référence (categori, niveau), invalidé à chaque écriture"""
+
+    def __init__(self, ttl: float = REFERENCE_CACHE_TTL):
+        self.ttl = ttl
+        self._entries: Dict[str, CachedReference] = {}
+
+    def get(self, name: str) -> Optional[CachedReference]:
+        entry = self._entries.get(name)
+        if entry is None or entry.expire_at < time.monotonic():
+            return None
+        return entry
+
+    def put(self, name: str, items: List[BaseModel]) -> CachedReference:
+        entry = CachedReference(jsonable_encoder(items), time.monotonic() + self.ttl)
+        self._entries[name] = entry
+        return entry
+
+    def invalidate(self, name: Optional[str] = None):
+        if name is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(name, None)
+
+    @staticmethod
+    def cache_headers(entry: CachedReference) -> dict:
+        return {
+            "ETag": entry.etag,
+            "Cache-Control": f"public, max-age={REFERENCE_CACHE_MAX_AGE}, must-revalidate",
+        }
+
+    @staticmethod
+    def is_not_modified(entry: CachedReference, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return entry.etag in candidates or "*" in candidates
+
+
+# Instance globale du cache
+reference_cache = ReferenceDataCache()
@@ -0,0 +1,224 @@
+import asyncio
+import os
+import uuid
+from typing import Any, Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..database import AsyncSessionLocal
+from ..models import Document, DocumentStatus, Notification, User, UserCounter
+from .metrics import metrics_registry
+
+load_dotenv()
+
+# Période de la réconciliation (secondes) ; 0 la désactive
+USER_COUNTERS_RECONCILE_INTERVAL = float(os.getenv("USER_COUNTERS_RECONCILE_INTERVAL", "900"))
+# Utilisateurs vérifiés (et verrouillés) par transaction
+USER_COUNTERS_RECONCILE_BATCH = int(os.getenv("USER_COUNTERS_RECONCILE_BATCH", "500"))
+
+COUNTER_COLUMNS = ("unread_notifications", "documents_pending", "documents_validate", "documents_refuse")
+
+# Colonne de compteur associée à chaque statut de demande
+STATUS_COLUMNS = {
+    DocumentStatus.PENDING.value: "documents_pending",
+    DocumentStatus.VALIDATE.value: "documents_validate",
+    DocumentStatus.REFUSE.value: "documents_refuse",
+}
+
+
+def status_column(status: Optional[str]) -> Optional[str]:
+    """Colonne du compteur d'un statut (None pour un statut inconnu, non compté)"""
+    return STATUS_COLUMNS.get(status)
+
+
+def document_status_delta(old_status: Optional[str], new_status: Optional[str]) -> Dict[str, int]:
+    """Delta de compteurs d'un changement de statut (vide si le statut ne change pas)"""
+    if old_status == new_status:
+        return {}
+    delta = {}
+    if status_column(old_status):
+        delta[status_column(old_status)] = -1
+    if status_column(new_status):
+        delta[status_column(new_status)] = 1
+    return delta
+
+
+def _as_uuid(user_id) -> uuid.UUID:
+    return user_id if isinstance(user_id, uuid.UUID) else uuid.UUID(str(user_id))
+
+
+# ==================== ÉCRITURE (même transaction que les données) ====================
+async def bump_user_counters(db: AsyncSession, deltas: Dict[Any, Dict[str, int]]):
+    """
+    Ajoute les deltas {user_id: {colonne: delta}} en un seul INSERT ... ON CONFLICT DO UPDATE
+    (commit fait par l'appelant). Les lignes sont triées par user_id : deux transactions
+    qui touchent les mêmes compteurs les verrouillent dans le même ordre.
+    """
+    # Une seule ligne par utilisateur : ON CONFLICT refuse de toucher deux fois la même ligne
+    merged: Dict[uuid.UUID, Dict[str, int]] = {}
+    for user_id, changes in deltas.items():
+        totals = merged.setdefault(_as_uuid(user_id), dict.fromkeys(COUNTER_COLUMNS, 0))
+        for column, delta in changes.items():
+            totals[column] += delta
+
+    rows = [
+        {"user_id": user_id, **totals}
+        for user_id, totals in sorted(merged.items())
+        if any(totals.values())
+    ]
+    if not rows:
+        return
+
+    stmt = pg_insert(UserCounter).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserCounter.user_id],
+        set_={
+            **{column: getattr(UserCounter, column) + getattr(stmt.excluded, column) for column in COUNTER_COLUMNS},
+            "updated_at": func.now(),
+        },
+    )
+    await db.execute(stmt)
+
+
+async def bump_unread_notifications(db: AsyncSession, user_ids: Iterable, delta: int = 1):
+    """Une notification (non lue) de plus ou de moins par occurrence de user_id"""
+    deltas: Dict[uuid.UUID, Dict[str, int]] = {}
+    for user_id in user_ids:
+        changes = deltas.setdefault(_as_uuid(user_id), {"unread_notifications": 0})
+        changes["unread_notifications"] += delta
+    await bump_user_counters(db, deltas)
+
+
+# ==================== LECTURE ====================
+async def get_user_counters(db: AsyncSession, user_id) -> Dict[str, int]:
+    """Lecture par clé primaire ; zéros si l'utilisateur n'a pas encore de compteurs"""
+    counter = await db.get(UserCounter, _as_uuid(user_id))
+    # Un delta négatif arrivé avant la première réconciliation ne doit pas afficher de badge négatif
+    return {column: max(getattr(counter, column), 0) if counter else 0 for column in COUNTER_COLUMNS}
+
+
+# ==================== RÉCONCILIATION ====================
+async def _actual_counts(db: AsyncSession, user_ids: List[uuid.UUID]) -> Dict[uuid.UUID, Dict[str, int]]:
+    """Valeurs recalculées depuis notification et document pour un lot d'utilisateurs"""
+    counts = {user_id: dict.fromkeys(COUNTER_COLUMNS, 0) for user_id in user_ids}
+
+    unread_stmt = select(Notification.user_id, func.count()).where(
+        Notification.user_id.in_(user_ids),
+        Notification.vue == False
+    ).group_by(Notification.user_id)
+    for user_id, count in (await db.execute(unread_stmt)).all():
+        counts[_as_uuid(user_id)]["unread_notifications"] = count
+
+    documents_stmt = select(Document.user_id, Document.status, func.count()).where(
+        Document.user_id.in_(user_ids),
+        Document.is_deleted == False
+    ).group_by(Document.user_id, Document.status)
+    for user_id, status, count in (await db.execute(documents_stmt)).all():
+        column = status_column(status)
+        if column:
+            counts[_as_uuid(user_id)][column] = count
+    return counts
+
+
+async def reconcile_user_counters(db: AsyncSession, batch_size: int = USER_COUNTERS_RECONCILE_BATCH) -> int:
+    """
+    Recalcule les compteurs et corrige ceux qui ont dérivé. Retourne le nombre de lignes corrigées.
+    Chaque lot est verrouillé (FOR UPDATE SKIP LOCKED) avant le recalcul : une écriture concurrente
+    soit attend la fin du lot et ajoute son delta ensuite, soit tient déjà le verrou et le lot
+    l'ignore jusqu'à la prochaine passe. La réconciliation n'attend jamais un verrou.
+    """
+    # Une ligne par utilisateur (utilisateurs antérieurs à la table, inscrits sans activité)
+    await db.execute(
+        pg_insert(UserCounter).from_select(["user_id"], select(User.id)).on_conflict_do_nothing()
+    )
+    await db.commit()
+
+    repaired = 0
+    last_user_id = None
+    while True:
+        stmt = select(UserCounter).order_by(UserCounter.user_id).limit(batch_size).with_for_update(skip_locked=True)
+        if last_user_id is not None:
+            stmt = stmt.where(UserCounter.user_id > last_user_id)
+        counters = (await db.execute(stmt)).scalars().all()
+        if not counters:
+            await db.commit()
+            return repaired
+
+        last_user_id = counters[-1].user_id
+        actual = await _actual_counts(db, [_as_uuid(counter.user_id) for counter in counters])
+        for counter in counters:
+            values = actual[_as_uuid(counter.user_id)]
+            if any(getattr(counter, column) != values[column] for column in COUNTER_COLUMNS):
+                for column in COUNTER_COLUMNS:
+                    setattr(counter, column, values[column])
+                repaired += 1
+        await db.commit()
+
+
+class CounterReconciler:
+    """Worker (un par processus) qui lance la réconciliation au démarrage puis à intervalle régulier"""
+
+    def __init__(
+            self,
+            session_factory=AsyncSessionLocal,
+            interval: float = USER_COUNTERS_RECONCILE_INTERVAL,
+            batch_size: int = USER_COUNTERS_RECONCILE_BATCH,
+    ):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+        # Exportés dans /metrics
+        self.runs_total = 0
+        self.repaired_total = 0
+
+    async def run_once(self) -> int:
+        async with self.session_factory() as db:
+            repaired = await reconcile_user_counters(db, self.batch_size)
+        self.runs_total += 1
+        self.repaired_total += repaired
+        if repaired:
+            print(f"Réconciliation des compteurs : {repaired} utilisateur(s) corrigé(s)")
+        return repaired
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Erreur de la réconciliation des compteurs : {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Instance globale de la réconciliation
+counter_reconciler = CounterReconciler()
+
+
+@metrics_registry.register
+def _collect_counter_metrics():
+    return [
+        ("user_counters_reconcile_runs_total", "counter", "Passes de réconciliation des compteurs utilisateur",
+         [({}, counter_reconciler.runs_total)]),
+        ("user_counters_repaired_total", "counter", "Compteurs utilisateur corrigés par la réconciliation (dérive)",
+         [({}, counter_reconciler.repaired_total)]),
+    ]
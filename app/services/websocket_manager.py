@@ -1,57 +1,245 @@
-from typing import Dict, Set
+from typing import Dict, Optional, Set
 from fastapi import WebSocket
+import asyncio
 import json
+import os
+
+from dotenv import load_dotenv
+
+from ..models import UserRole
+from .backplane import Backplane, create_backplane
+from .metrics import metrics_registry
+
+try:
+    import orjson
+except ImportError:  # orjson est optionnel : json de la stdlib sinon
+    orjson = None
+
+load_dotenv()
+
+# Délai max d'un send sur une socket avant de considérer le client comme bloqué (secondes)
+WEBSOCKET_SEND_TIMEOUT = float(os.getenv("WEBSOCKET_SEND_TIMEOUT", "5.0"))
+# Messages en attente par connexion ; au-delà, le client est jugé trop lent et déconnecté
+WEBSOCKET_SEND_QUEUE_SIZE = int(os.getenv("WEBSOCKET_SEND_QUEUE_SIZE", "100"))
+
+# Heartbeat au niveau du protocole (trames ping/pong WebSocket, gérées par uvicorn et le navigateur) :
+# ping toutes les N secondes, connexion fermée si le pong n'arrive pas avant le timeout.
+# Les clients n'ont rien à envoyer ; une connexion morte termine receive_text() et passe par disconnect().
+WEBSOCKET_PING_INTERVAL = float(os.getenv("WEBSOCKET_PING_INTERVAL", "20"))
+WEBSOCKET_PING_TIMEOUT = float(os.getenv("WEBSOCKET_PING_TIMEOUT", "20"))
+
+# Rôles qui reçoivent les diffusions "admins"
+ADMIN_ROLES = (UserRole.ADMIN.value, UserRole.SCO.value)
+
+
+# Python 3.11+ : asyncio.timeout évite la tâche intermédiaire créée par wait_for à chaque envoi
+_asyncio_timeout = getattr(asyncio, "timeout", None)
+
+
+def encode_message(message: dict) -> str:
+    """Sérialise un message une seule fois pour tous ses destinataires (même format que send_json)"""
+    if orjson is not None:
+        return orjson.dumps(message).decode("utf-8")
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+
+class ClientConnection:
+    """
+    Une socket et sa file d'envoi. Un writer dédié vide la file : un client lent
+    n'avance qu'à son rythme sans retarder les autres, et il est évincé s'il bloque.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: str, role: Optional[str], manager: "ConnectionManager"):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.role = role
+        self.manager = manager
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=manager.send_queue_size)
+        self.closed = False
+        self._socket_closed = False
+        self._writer = asyncio.create_task(self._write())
+
+    def enqueue(self, message: str) -> bool:
+        """Ajoute le message déjà encodé sans attendre ; False si la file est pleine (client trop lent)"""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _send(self, message: str):
+        if _asyncio_timeout is not None:
+            async with _asyncio_timeout(self.manager.send_timeout):
+                await self.websocket.send_text(message)
+        else:
+            await asyncio.wait_for(self.websocket.send_text(message), timeout=self.manager.send_timeout)
+
+    async def _write(self):
+        while True:
+            message = await self.queue.get()
+            try:
+                await self._send(message)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                print(f"Client WebSocket {self.user_id} trop lent (send > {self.manager.send_timeout}s), déconnexion")
+                break
+            except Exception as e:
+                print(f"Error sending message to user {self.user_id}: {e}")
+                break
+        self.manager.spawn(self.manager.evict(self))
+
+    def detach(self):
+        """Arrête le writer : plus aucun message ne sera envoyé sur cette socket"""
+        self.closed = True
+        self._writer.cancel()
+
+    async def close(self):
+        """Ferme la socket (sans erreur si elle est déjà fermée)"""
+        if self._socket_closed:
+            return
+        self._socket_closed = True
+        try:
+            await asyncio.wait_for(self.websocket.close(code=1013), timeout=self.manager.send_timeout)
+        except Exception:
+            pass
 
 
 class ConnectionManager:
     """Gère les connexions WebSocket pour les notifications en temps réel"""
-    
-    def __init__(self):
-        # Dictionnaire pour stocker les connexions : {user_id: {websocket1, websocket2, ...}}
-        self.active_connections: Dict[int, Set[WebSocket]] = {}
-    
-    async def connect(self, websocket: WebSocket, user_id: str):
+
+    def __init__(
+            self,
+            backplane: Optional[Backplane] = None,
+            send_timeout: float = WEBSOCKET_SEND_TIMEOUT,
+            send_queue_size: int = WEBSOCKET_SEND_QUEUE_SIZE,
+    ):
+        # Dictionnaire pour stocker les connexions : {user_id: {connexion1, connexion2, ...}}
+        self.active_connections: Dict[str, Set[ClientConnection]] = {}
+        # Index par rôle : {role: {connexion1, ...}} pour cibler les admins sans parcourir les étudiants
+        self.role_index: Dict[str, Set[ClientConnection]] = {}
+        self._by_socket: Dict[WebSocket, ClientConnection] = {}
+        # Références des évictions en cours (sinon les tâches peuvent être collectées)
+        self._background: Set[asyncio.Task] = set()
+        self.send_timeout = send_timeout
+        self.send_queue_size = send_queue_size
+        # Compteur exporté dans /metrics
+        self.evicted_total = 0
+        # Les envois passent par le backplane pour atteindre les sockets des autres workers
+        self.backplane = backplane if backplane is not None else create_backplane()
+
+    async def start(self):
+        await self.backplane.start(self._deliver)
+
+    async def stop(self):
+        await self.backplane.stop()
+        for client in list(self._by_socket.values()):
+            self.disconnect(client.websocket, client.user_id)
+            await client.close()
+
+    async def _deliver(self, envelope: dict):
+        """Livre une enveloppe reçue du backplane aux sockets de ce processus"""
+        if envelope.get("target") == "user":
+            self._send_local(envelope["message"], envelope["user_id"])
+        elif envelope.get("target") == "admins":
+            self._broadcast_local(envelope["message"], ADMIN_ROLES)
+
+    async def connect(self, websocket: WebSocket, user_id: str, role: Optional[str] = None):
         """Connecte un utilisateur via WebSocket"""
         await websocket.accept()
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = set()
-        self.active_connections[user_id].add(websocket)
-    
+        client = ClientConnection(websocket, user_id, role, self)
+        self._by_socket[websocket] = client
+        self.active_connections.setdefault(user_id, set()).add(client)
+        if role is not None:
+            self.role_index.setdefault(role, set()).add(client)
+
     def disconnect(self, websocket: WebSocket, user_id: str):
         """Déconnecte un utilisateur"""
-        if user_id in self.active_connections:
-            self.active_connections[user_id].discard(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-    
+        client = self._by_socket.pop(websocket, None)
+        if client is None:
+            return
+        client.detach()
+
+        connections = self.active_connections.get(client.user_id)
+        if connections is not None:
+            connections.discard(client)
+            if not connections:
+                del self.active_connections[client.user_id]
+        if client.role is not None:
+            connections = self.role_index.get(client.role)
+            if connections is not None:
+                connections.discard(client)
+                if not connections:
+                    del self.role_index[client.role]
+
+    def connection_counts(self) -> Dict[str, int]:
+        """Nombre de connexions vivantes par rôle (role inconnu : 'unknown')"""
+        counts = {role: len(clients) for role, clients in self.role_index.items()}
+        unknown = sum(1 for client in self._by_socket.values() if client.role is None)
+        if unknown:
+            counts["unknown"] = unknown
+        return counts
+
+    def spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def evict(self, client: ClientConnection):
+        """Retire un client lent ou mort et ferme sa socket"""
+        if not client.closed:
+            self.evicted_total += 1
+        self.disconnect(client.websocket, client.user_id)
+        await client.close()
+
+    def _enqueue_all(self, clients, message: dict):
+        if not clients:
+            return
+        text = encode_message(message)
+        for client in clients:
+            if not client.enqueue(text) and not client.closed:
+                print(f"File d'envoi pleine pour {client.user_id}, déconnexion du client")
+                self.evicted_total += 1
+                # Retrait immédiat des index : les diffusions suivantes ne le visent plus
+                self.disconnect(client.websocket, client.user_id)
+                self.spawn(client.close())
+
     async def send_personal_message(self, message: dict, user_id: str):
-        """Envoie un message à un utilisateur spécifique"""
-        if user_id in self.active_connections:
-            disconnected = set()
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_json(message)
-                except Exception as e:
-                    print(f"Error sending message to user {user_id}: {e}")
-                    disconnected.add(connection)
-            
-            # Nettoyer les connexions déconnectées
-            for connection in disconnected:
-                self.disconnect(connection, user_id)
-    
+        """Envoie un message à un utilisateur spécifique, quel que soit le worker qui porte sa socket"""
+        await self.backplane.publish({"target": "user", "user_id": str(user_id), "message": message})
+
     async def broadcast_to_admins(self, message: dict):
-        """Envoie un message à tous les administrateurs connectés"""
-        # Pour simplifier, on peut envoyer à tous les utilisateurs
-        # ou maintenir une liste séparée d'admins
-        for user_id, connections in self.active_connections.items():
-            for connection in connections:
-                try:
-                    await connection.send_json(message)
-                except Exception:
-                    pass
+        """Envoie un message aux administrateurs et à la scolarité connectés (sur tous les workers)"""
+        await self.backplane.publish({"target": "admins", "message": message})
+
+    def reply(self, websocket: WebSocket, message: dict):
+        """Répond sur une socket précise (ce processus), via sa file d'envoi comme tout autre message"""
+        client = self._by_socket.get(websocket)
+        if client is not None:
+            self._enqueue_all([client], message)
+
+    def _send_local(self, message: dict, user_id: str):
+        self._enqueue_all(list(self.active_connections.get(user_id, ())), message)
+
+    def _broadcast_local(self, message: dict, roles):
+        clients = [client for role in roles for client in self.role_index.get(role, ())]
+        self._enqueue_all(clients, message)
 
 
 # Instance globale du gestionnaire de connexions
 manager = ConnectionManager()
 
 
+@metrics_registry.register
+def _collect_websocket_metrics():
+    counts = manager.connection_counts()
+    return [
+        ("websocket_connections", "gauge", "Connexions WebSocket vivantes sur ce worker, par rôle",
+         [({"role": role}, count) for role, count in sorted(counts.items())]),
+        ("websocket_users", "gauge", "Utilisateurs distincts connectés sur ce worker",
+         [({}, len(manager.active_connections))]),
+        ("websocket_evicted_total", "counter", "Clients retirés car trop lents ou en erreur d'envoi",
+         [({}, manager.evicted_total)]),
+    ]
@@ -0,0 +1,90 @@
+"""
+Benchmark du démarrage d'un worker
+1. python -X importtime : coût de l'import de app.main et modules les plus lourds
+2. temps jusqu'à la première réponse : import + lifespan + GET /
+Chaque mesure tourne dans un processus neuf (aucun module déjà importé)
+Usage : python bench_startup.py [nombre_de_répétitions]
+"""
+import statistics
+import subprocess
+import sys
+
+FIRST_REQUEST_SCRIPT = """
+import asyncio
+import time
+started = time.perf_counter()
+from app.main import app
+imported = time.perf_counter()
+import httpx
+
+async def run():
+    async with app.router.lifespan_context(app):
+        ready = time.perf_counter()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            response = await client.get("/")
+        answered = time.perf_counter()
+    print(imported - started, ready - imported, answered - ready, response.status_code)
+
+asyncio.run(run())
+"""
+
+
+def import_profile(top: int = 10):
+    """Retourne (temps cumulé de app.main en ms, [(ms, paquet), ...] des paquets les plus coûteux)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        capture_output=True, text=True, check=True
+    )
+    total = 0.0
+    by_package = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative, name = (part.strip() for part in line.removeprefix("import time:").split("|"))
+        if name == "app.main":
+            total = int(cumulative) / 1000
+        # Temps propre additionné par paquet racine : pas de double compte entre parents et enfants
+        package = name.split(".")[0]
+        by_package[package] = by_package.get(package, 0.0) + int(self_us) / 1000
+    heaviest = sorted(((ms, package) for package, ms in by_package.items()), reverse=True)
+    return total, heaviest[:top]
+
+
+def first_request():
+    result = subprocess.run(
+        [sys.executable, "-c", FIRST_REQUEST_SCRIPT],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    imported, startup, request, status_code = result.stdout.strip().splitlines()[-1].split()
+    return float(imported), float(startup), float(request), int(status_code)
+
+
+def main(runs: int):
+    total, roots = import_profile()
+    print(f"Import de app.main : {total:.1f} ms (python -X importtime)")
+    for cumulative, name in roots:
+        print(f"  {cumulative:8.1f} ms  {name}")
+
+    samples = []
+    for _ in range(runs):
+        try:
+            samples.append(first_request())
+        except RuntimeError as e:
+            print(f"Première requête impossible (base de données démarrée ?) : {e}")
+            return
+
+    def median(index):
+        return statistics.median(sample[index] for sample in samples) * 1000
+
+    print(f"\nPremière requête, médiane sur {runs} processus :")
+    print(f"  import      {median(0):8.1f} ms")
+    print(f"  lifespan    {median(1):8.1f} ms")
+    print(f"  GET /       {median(2):8.1f} ms (HTTP {samples[0][3]})")
+    print(f"  total       {median(0) + median(1) + median(2):8.1f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,93 @@
+"""
+Micro-benchmark de la diffusion WebSocket (sans réseau ni base de données)
+Mesure le coût d'encodage (par socket contre unique) et la diffusion complète via le ConnectionManager
+Usage : python bench_websocket_fanout.py [nombre_de_sockets ...]
+"""
+import asyncio
+import json
+import sys
+import time
+
+from app.services.backplane import LocalBackplane
+from app.services.websocket_manager import ConnectionManager, encode_message, orjson
+
+MESSAGE = {
+    "type": "new_request",
+    "message": "Nouvelle demande de document à examiner",
+    "document": {"id": 1234, "numero": 20250042, "status": "pending", "categorie": "Relevé de notes"},
+    "recipients": list(range(20)),
+}
+EVENTS = 20
+
+
+class FakeWebSocket:
+    """Socket sans I/O : ne mesure que le coût côté serveur"""
+
+    def __init__(self, done: asyncio.Event, expected: int):
+        self.sent = 0
+        self.done = done
+        self.expected = expected
+
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, data: str):
+        self._count()
+
+    def _count(self):
+        self.sent += 1
+        if self.sent == self.expected:
+            self.done.set()
+
+
+def bench_serialization(count: int):
+    """Coût d'encodage d'un événement : une fois par destinataire (send_json) contre une seule fois"""
+    started = time.perf_counter()
+    for _ in range(EVENTS):
+        for _ in range(count):
+            json.dumps(MESSAGE, ensure_ascii=False, separators=(",", ":"))
+    per_socket = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(EVENTS):
+        encode_message(MESSAGE)
+    once = time.perf_counter() - started
+    return per_socket, once
+
+
+async def bench_manager(count: int) -> float:
+    """ConnectionManager : un encodage par événement, puis mise en file par socket"""
+    manager = ConnectionManager(LocalBackplane(), send_queue_size=EVENTS + 1)
+    await manager.start()
+    events = [asyncio.Event() for _ in range(count)]
+    for index, event in enumerate(events):
+        await manager.connect(FakeWebSocket(event, EVENTS), f"user-{index}", "admin")
+
+    started = time.perf_counter()
+    for _ in range(EVENTS):
+        await manager.broadcast_to_admins(MESSAGE)
+    await asyncio.gather(*(event.wait() for event in events))
+    elapsed = time.perf_counter() - started
+
+    await manager.stop()
+    return elapsed
+
+
+async def main(counts):
+    encoder = "orjson" if orjson is not None else "json"
+    print(f"{EVENTS} événements par mesure, message de {len(encode_message(MESSAGE))} octets, encodeur {encoder}")
+    for count in counts:
+        per_socket, once = bench_serialization(count)
+        fan_out = await bench_manager(count)
+        print(
+            f"{count:>6} sockets : sérialisation {per_socket * 1e3 / EVENTS:8.3f} ms/événement (par socket)"
+            f" -> {once * 1e3 / EVENTS:6.3f} ms/événement (unique)"
+            f" | diffusion complète {fan_out * 1e3 / EVENTS:8.3f} ms/événement"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main([int(arg) for arg in sys.argv[1:]] or [1000, 10000]))
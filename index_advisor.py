@@ -0,0 +1,175 @@
+"""
+Conseiller d'index
+Exécute les lectures de app/crud.py, capture chaque SELECT émis (requête principale et selectinload)
+puis lance EXPLAIN (ANALYZE, BUFFERS) dessus et signale les Seq Scan sur des tables volumineuses.
+Avec --seed N, des données synthétiques sont insérées dans une transaction annulée à la fin :
+la base n'est pas modifiée.
+Usage : python index_advisor.py [--seed 20000] [--min-rows 1000]
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+from sqlalchemy import event, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.crud import (
+    compute_stats_for_dashboard, count_unread_notifications, get_all_users, get_document_request_by_id,
+    get_document_requests_filtered, get_notification_for_active_user, get_pending_users, get_user_by_email,
+    get_user_document_requests,
+)
+from app.database import async_engine
+from app.models import Categori, Document, User, UserRole
+from app.schemas import DocumentRequestFilter, Principal, UserRequestFilter
+
+SEED_SQL = [
+    """
+    INSERT INTO categori (id, designation, montant, is_visible, with_parent)
+    SELECT (SELECT coalesce(max(id), 0) FROM categori) + g, 'advisor-' || g, 1000, true, false
+    FROM generate_series(1, 8) g
+    """,
+    """
+    INSERT INTO users (id, email, hashed_password, nom, prenom, matricule, type, is_active, is_deleted, created_at)
+    SELECT gen_random_uuid(), 'advisor' || g || '@example.com', 'x', 'Nom' || g, 'Prenom' || g, 'ADV' || g,
+           CASE WHEN g % 50 = 0 THEN 'admin' WHEN g % 25 = 0 THEN 'sco' ELSE 'etudiant' END,
+           g % 10 <> 0, false, now() - (g || ' minutes')::interval
+    FROM generate_series(1, :users) g
+    """,
+    """
+    INSERT INTO document (user_id, categorie_id, status, est_paye, is_deleted, date_de_demande, created_at)
+    SELECT u.id, c.id, (ARRAY['pending', 'validate', 'refuse'])[1 + g % 3], g % 4 = 0, false,
+           now() - (g || ' minutes')::interval, now()
+    FROM generate_series(1, :documents) g
+    JOIN LATERAL (SELECT id FROM users WHERE email = 'advisor' || (1 + g % :users) || '@example.com') u ON true
+    JOIN LATERAL (SELECT id FROM categori WHERE designation = 'advisor-' || (1 + g % 8)) c ON true
+    """,
+    """
+    INSERT INTO notification (user_id, document_id, contenu, type_notif, vue, date_de_notification)
+    SELECT d.user_id, d.id, 'notification', 'request', d.id % 3 = 0, d.date_de_demande
+    FROM document d JOIN users u ON u.id = d.user_id WHERE u.email LIKE 'advisor%'
+    """,
+]
+
+
+class StatementRecorder:
+    """Garde les SELECT envoyés à la base pendant un scénario (SQL du driver + paramètres)"""
+
+    def __init__(self):
+        self.statements = []
+        self.enabled = False
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled and statement.lstrip().upper().startswith("SELECT"):
+            self.statements.append((statement, parameters))
+
+
+def seq_scans(plan: dict, min_rows: int):
+    """Parcourt le plan JSON et retourne les Seq Scan qui lisent au moins min_rows lignes"""
+    found = []
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        if node.get("Node Type") == "Seq Scan":
+            scanned = (node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0)) * node.get("Actual Loops", 1)
+            if scanned >= min_rows:
+                found.append((node.get("Relation Name"), int(scanned), node.get("Filter")))
+        stack.extend(node.get("Plans", []))
+    return found
+
+
+async def scenarios(db: AsyncSession):
+    """Une entrée par accès en lecture de app/crud.py (label, coroutine)"""
+    admin = (await db.execute(select(User.id).where(User.type == UserRole.ADMIN.value).limit(1))).scalar()
+    student_row = (await db.execute(
+        select(User.id, User.email).where(User.type == UserRole.ETUDIANT.value).order_by(User.created_at.desc()).limit(1)
+    )).first()
+    document_id = (await db.execute(select(Document.id).order_by(Document.id.desc()).limit(1))).scalar()
+    categorie_id = (await db.execute(select(Categori.id).limit(1))).scalar()
+    if admin is None or student_row is None or document_id is None:
+        raise SystemExit("Base vide : lancez init_db.py ou utilisez --seed N")
+
+    admin_principal = Principal(id=admin, type=UserRole.ADMIN.value, is_active=True)
+    student_principal = Principal(id=student_row.id, type=UserRole.ETUDIANT.value, is_active=True)
+
+    _, meta = await get_document_requests_filtered(db, DocumentRequestFilter(mode="cursor"), admin_principal)
+    return [
+        ("requests: admin, page 1 (offset)", lambda: get_document_requests_filtered(db, DocumentRequestFilter(), admin_principal)),
+        ("requests: admin, page 50 (offset)", lambda: get_document_requests_filtered(db, DocumentRequestFilter(page=50), admin_principal)),
+        ("requests: admin, page 2 (cursor)", lambda: get_document_requests_filtered(
+            db, DocumentRequestFilter(mode="cursor", cursor=meta.next_cursor, count="none"), admin_principal)),
+        ("requests: status=pending", lambda: get_document_requests_filtered(db, DocumentRequestFilter(status="pending"), admin_principal)),
+        ("requests: categorie_id", lambda: get_document_requests_filtered(db, DocumentRequestFilter(categorie_id=categorie_id), admin_principal)),
+        ("requests: search numero", lambda: get_document_requests_filtered(db, DocumentRequestFilter(search_term="42"), admin_principal)),
+        ("requests: search text", lambda: get_document_requests_filtered(db, DocumentRequestFilter(search_term="Nom12"), admin_principal)),
+        ("requests: student", lambda: get_document_requests_filtered(db, DocumentRequestFilter(), student_principal)),
+        ("requests: by user", lambda: get_user_document_requests(db, student_row.id)),
+        ("requests: by id", lambda: get_document_request_by_id(db, document_id)),
+        ("users: all", lambda: get_all_users(db, UserRequestFilter())),
+        ("users: etudiant inactive", lambda: get_all_users(db, UserRequestFilter(type="etudiant", status=False))),
+        ("users: pending", lambda: get_pending_users(db)),
+        ("users: by email", lambda: get_user_by_email(db, student_row.email)),
+        ("notifications: inbox", lambda: get_notification_for_active_user(db, student_row.id)),
+        ("notifications: inbox unread", lambda: get_notification_for_active_user(db, student_row.id, unread_only=True)),
+        ("notifications: unread count", lambda: count_unread_notifications(db, student_row.id)),
+        ("stats: dashboard", lambda: compute_stats_for_dashboard(db)),
+    ]
+
+
+async def main(seed: int, min_rows: int) -> int:
+    recorder = StatementRecorder()
+    event.listen(async_engine.sync_engine, "before_cursor_execute", recorder)
+    flagged = 0
+
+    async with async_engine.connect() as conn:
+        transaction = await conn.begin()
+        try:
+            if seed:
+                print(f"Insertion de données synthétiques ({seed} demandes, annulées à la fin)...")
+                params = {"users": max(seed // 5, 10), "documents": seed}
+                for statement in SEED_SQL:
+                    await conn.execute(text(statement), params)
+                await conn.execute(text("ANALYZE"))
+
+            # Les commits éventuels des fonctions CRUD deviennent des savepoints : rien n'est écrit
+            db = AsyncSession(bind=conn, join_transaction_mode="create_savepoint", expire_on_commit=False)
+            for label, run in await scenarios(db):
+                recorder.statements.clear()
+                recorder.enabled = True
+                try:
+                    await run()
+                finally:
+                    recorder.enabled = False
+                db.expunge_all()
+
+                for index, (statement, parameters) in enumerate(recorder.statements, start=1):
+                    result = await conn.exec_driver_sql(
+                        "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters
+                    )
+                    raw = result.scalar()
+                    plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]
+                    root = plan["Plan"]
+                    scans = seq_scans(root, min_rows)
+                    flagged += len(scans)
+                    marker = "SEQ " if scans else "ok  "
+                    print(
+                        f"{marker} {label} [{index}] {plan['Execution Time']:8.2f} ms"
+                        f"  buffers hit={root.get('Shared Hit Blocks', 0)} read={root.get('Shared Read Blocks', 0)}"
+                    )
+                    for relation, rows, condition in scans:
+                        print(f"       Seq Scan sur {relation} ({rows} lignes lues) filtre : {condition or '-'}")
+        finally:
+            await transaction.rollback()
+
+    event.remove(async_engine.sync_engine, "before_cursor_execute", recorder)
+    await async_engine.dispose()
+    print(f"\n{flagged} Seq Scan signalé(s) (seuil : {min_rows} lignes lues)")
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EXPLAIN (ANALYZE, BUFFERS) des requêtes de app/crud.py")
+    parser.add_argument("--seed", type=int, default=0, help="Nombre de demandes synthétiques à insérer (transaction annulée)")
+    parser.add_argument("--min-rows", type=int, default=1000, help="Seuil de lignes lues pour signaler un Seq Scan")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.seed, args.min_rows)))
@@ -1,3 +1,5 @@
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import Session
 from app.database import SessionLocal, engine, Base
 from app.models import User, UserRole, Categori, Niveau
@@ -7,10 +9,37 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+def install_pg_trgm():
+    """
+    Installe l'extension pg_trgm (index trigrammes et classement par similarity() de la recherche).
+    Nécessite le paquet contrib de PostgreSQL et un rôle superutilisateur ou propriétaire de la base.
+    Sans elle, l'application fonctionne : la recherche se rabat sur ILIKE sans index ni classement fin.
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        print("✅ Extension pg_trgm disponible")
+    except DBAPIError as e:
+        print(f"⚠️  Extension pg_trgm indisponible, index trigrammes ignorés : {e.orig}")
+
+
+def create_missing_indexes():
+    """
+    create_all ne crée les index que pour les nouvelles tables :
+    on ajoute ici ceux déclarés dans les modèles mais absents d'une base existante.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
 def init_db():
     """Crée les tables, un admin par défaut et les catégories de documents"""
+    # Extension d'abord : les index trigrammes ne sont créés que si elle est installée
+    install_pg_trgm()
     # Créer les tables
     Base.metadata.create_all(bind=engine)
+    create_missing_indexes()
     
     db = SessionLocal()
     try:
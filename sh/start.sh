@@ -19,5 +19,7 @@ python3 scripts/init_db.py
 
 # Démarrer l'application
 echo "✅ Démarrage du serveur..."
-uvicorn app.main:app --reload --host 0.0.0.0 --port 8000
+# Heartbeat WebSocket : trames ping/pong du protocole (aucun message applicatif côté client)
+uvicorn app.main:app --reload --host 0.0.0.0 --port 8000 \
+    --ws-ping-interval "${WEBSOCKET_PING_INTERVAL:-20}" --ws-ping-timeout "${WEBSOCKET_PING_TIMEOUT:-20}"
 
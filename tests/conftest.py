@@ -0,0 +1,41 @@
+import os
+
+import pytest
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+# Configuration minimale pour importer l'application sans .env (aucune connexion n'est ouverte à l'import)
+os.environ.setdefault("SMTP_USER", "test")
+os.environ.setdefault("SMTP_PASS", "test")
+os.environ.setdefault("SMTP_FROM", "noreply@example.com")
+os.environ.setdefault("SMTP_HOST", "localhost")
+os.environ.setdefault("SMTP_PORT", "1025")
+os.environ.setdefault("ABLY_API_KEY", "test.key:secret")
+
+# Base PostgreSQL réservée aux tests, vidée avant chaque test qui l'utilise.
+# Sans TEST_DATABASE_URL, ces tests sont ignorés.
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def session_factory():
+    """Fabrique de sessions asyncpg (mêmes réglages que AsyncSessionLocal) sur une base vide"""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    from app.database import Base
+    # Enregistre les tables dans Base.metadata
+    import app.models  # noqa: F401
+
+    engine = create_async_engine(make_url(TEST_DATABASE_URL).set(drivername="postgresql+asyncpg"))
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # DELETE plutôt que TRUNCATE : quelques lignes par test, pas de fichiers à recréer
+        for table in reversed(Base.metadata.sorted_tables):
+            await conn.execute(table.delete())
+    yield async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    await engine.dispose()
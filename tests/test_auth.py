@@ -0,0 +1,190 @@
+import asyncio
+import threading
+import uuid
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from app import auth
+from app.auth import (
+    cache_principal, create_access_token, get_cached_principal, get_current_user, get_password_hash_async,
+    invalidate_principal, verify_password_async
+)
+from app.crud import delete_user, update_user
+from app.main import app
+from app.models import User
+from app.schemas import Principal, UserUpdate
+
+
+@pytest.fixture(autouse=True)
+def empty_principal_cache(monkeypatch):
+    monkeypatch.setattr(auth, "_principal_cache", {})
+
+
+def _principal(**fields):
+    return Principal(**{"id": uuid.uuid4(), "type": "etudiant", "is_active": True, **fields})
+
+
+# ==================== CACHE DES PRINCIPAL ====================
+def test_cached_principal_until_invalidated():
+    principal = _principal()
+    cache_principal(principal)
+    assert get_cached_principal(str(principal.id)) is principal
+
+    invalidate_principal(principal.id)
+    assert get_cached_principal(str(principal.id)) is None
+
+
+def test_expired_principal_is_dropped(monkeypatch):
+    monkeypatch.setattr(auth, "PRINCIPAL_CACHE_TTL", -1)
+    principal = _principal()
+    cache_principal(principal)
+    assert get_cached_principal(str(principal.id)) is None
+    assert str(principal.id) not in auth._principal_cache
+
+
+def test_oldest_principal_is_evicted(monkeypatch):
+    monkeypatch.setattr(auth, "PRINCIPAL_CACHE_MAX_SIZE", 2)
+    first, second, third = _principal(), _principal(), _principal()
+    for principal in (first, second, third):
+        cache_principal(principal)
+    assert get_cached_principal(str(first.id)) is None
+    assert get_cached_principal(str(third.id)) is third
+
+
+# ==================== POOL BCRYPT ====================
+@pytest.mark.anyio
+async def test_hash_runs_in_bcrypt_pool():
+    threads = []
+    hashed = await auth._run_password_hash(lambda: threads.append(threading.current_thread().name) or "h")
+    assert hashed == "h"
+    assert threads[0].startswith("bcrypt")
+    assert await verify_password_async("pw", await get_password_hash_async("pw"))
+
+
+@pytest.mark.anyio
+async def test_saturated_pool_answers_503(monkeypatch):
+    slots = asyncio.Semaphore(1)
+    monkeypatch.setattr(auth, "_password_hash_slots", slots)
+    monkeypatch.setattr(auth, "PASSWORD_HASH_QUEUE_TIMEOUT", 0.05)
+    await slots.acquire()
+
+    with pytest.raises(HTTPException) as exc_info:
+        await get_password_hash_async("pw")
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers == {"Retry-After": "1"}
+
+    slots.release()
+    assert await get_password_hash_async("pw")
+
+
+@pytest.mark.anyio
+async def test_failed_hash_releases_its_slot(monkeypatch):
+    slots = asyncio.Semaphore(1)
+    monkeypatch.setattr(auth, "_password_hash_slots", slots)
+
+    def broken():
+        raise ValueError("hash invalide")
+
+    with pytest.raises(ValueError):
+        await auth._run_password_hash(broken)
+    assert not slots.locked()
+
+
+# ==================== /metrics ====================
+async def _scrape(authorization=None):
+    headers = {"Authorization": authorization} if authorization else {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        return await client.get("/metrics", headers=headers)
+
+
+def _bearer_for(principal):
+    # Principal en cache : get_current_user ne lit pas la base
+    cache_principal(principal)
+    return "Bearer " + create_access_token({"id": str(principal.id)})
+
+
+@pytest.mark.anyio
+async def test_metrics_require_credentials(monkeypatch):
+    monkeypatch.setattr(auth, "METRICS_TOKEN", "scrape-secret")
+    assert (await _scrape()).status_code == 401
+    assert (await _scrape("Bearer autre")).status_code == 401
+
+
+@pytest.mark.anyio
+async def test_metrics_accept_scraper_token(monkeypatch):
+    monkeypatch.setattr(auth, "METRICS_TOKEN", "scrape-secret")
+    response = await _scrape("Bearer scrape-secret")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+
+
+@pytest.mark.anyio
+async def test_metrics_without_token_are_admin_only(monkeypatch):
+    monkeypatch.setattr(auth, "METRICS_TOKEN", "")
+    assert (await _scrape("Bearer ")).status_code == 401
+    assert (await _scrape(_bearer_for(_principal()))).status_code == 403
+    assert (await _scrape(_bearer_for(_principal(type="admin", is_active=False)))).status_code == 400
+    assert (await _scrape(_bearer_for(_principal(type="admin")))).status_code == 200
+
+
+# ==================== BASE DE DONNÉES ====================
+async def _user(session_factory, **columns):
+    async with session_factory() as db:
+        user = User(id=uuid.uuid4(), email=f"{uuid.uuid4().hex}@example.com", hashed_password="x",
+                    nom="Rakoto", prenom="Jean", is_active=True, type="etudiant", **columns)
+        db.add(user)
+        await db.commit()
+        return user
+
+
+async def _current_user(session_factory, user):
+    token = create_access_token({"sub": user.email, "id": str(user.id)})
+    async with session_factory() as db:
+        return await get_current_user(token, db)
+
+
+@pytest.mark.anyio
+async def test_update_user_refreshes_cached_principal(session_factory):
+    user = await _user(session_factory)
+    assert (await _current_user(session_factory, user)).is_active
+
+    async with session_factory() as db:
+        await update_user(db, str(user.id), UserUpdate(is_active=False, type="sco"))
+
+    principal = await _current_user(session_factory, user)
+    assert not principal.is_active
+    assert principal.type == "sco"
+
+
+@pytest.mark.anyio
+async def test_principal_is_served_from_cache(session_factory):
+    user = await _user(session_factory)
+    cached = await _current_user(session_factory, user)
+
+    async with session_factory() as db:
+        await db.delete(await db.get(User, user.id))
+        await db.commit()
+
+    # Sans passer par crud, rien n'invalide le cache : la base n'est pas relue
+    assert await _current_user(session_factory, user) is cached
+
+
+@pytest.mark.anyio
+async def test_delete_user_invalidates_cached_principal(session_factory):
+    user = await _user(session_factory)
+    await _current_user(session_factory, user)
+
+    async with session_factory() as db:
+        assert await delete_user(db, str(user.id))
+
+    assert get_cached_principal(str(user.id)) is None
+
+
+@pytest.mark.anyio
+async def test_unknown_user_is_rejected(session_factory):
+    user = User(id=uuid.uuid4(), email="ghost@example.com")
+    with pytest.raises(HTTPException) as exc_info:
+        await _current_user(session_factory, user)
+    assert exc_info.value.status_code == 401
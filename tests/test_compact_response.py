@@ -0,0 +1,67 @@
+import json
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+from app.main import _compact_page_response
+from app.models import Categori, Document, User
+from app.schemas import PaginationMeta, sparse_compact_page_model
+
+NOW = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def documents():
+    student = User(
+        id=uuid.uuid4(), email="etudiant@example.com", nom="Rakoto", prenom="Jean",
+        type="etudiant", is_active=True, created_at=NOW,
+    )
+    releve = Categori(
+        id=1, designation="Relevé de notes", montant=10.0,
+        is_visible=True, with_parent=False, with_info=False,
+    )
+    return [
+        Document(
+            id=row_id, numero=row_id, user_id=student.id, user=student, categorie_id=releve.id, categorie=releve,
+            status="pending", est_paye=False, is_deleted=False, date_de_demande=NOW, created_at=NOW, infosupps=[],
+        )
+        for row_id in (1, 2, 3)
+    ]
+
+
+def _render(fieldset, documents):
+    pagination = PaginationMeta(page=1, page_total=1, per_page=10, total_items=len(documents))
+    return json.loads(_compact_page_response(fieldset, documents, pagination).body)
+
+
+def test_shared_entities_are_included_once(documents):
+    page = _render(None, documents)
+    assert list(page["included"]["users"]) == [str(documents[0].user_id)]
+    assert list(page["included"]["categories"]) == ["1"]
+    assert [row["id"] for row in page["data"]] == [1, 2, 3]
+
+
+def test_rows_reference_entities_by_id(documents):
+    row = _render(None, documents)["data"][0]
+    assert "user" not in row and "categorie" not in row
+    assert row["user_id"] == str(documents[0].user_id)
+    assert row["categorie_id"] == 1
+    assert row["document_type"] == "Relevé de notes"
+
+
+def test_sparse_compact_page_emits_only_requested_relations(documents):
+    page = _render(("id", "numero", "categorie"), documents)
+    assert page["data"][0] == {"id": 1, "categorie_id": 1, "numero": 1}
+    assert page["included"] == {"users": {}, "categories": {"1": page["included"]["categories"]["1"]}}
+
+
+def test_sparse_compact_page_without_relations(documents):
+    page = _render(("id", "status"), documents)
+    assert page["data"][0] == {"id": 1, "status": "pending"}
+    assert page["included"] == {"users": {}, "categories": {}}
+
+
+def test_sparse_compact_page_model_is_cached_per_fieldset():
+    names = ("id", "user_id")
+    assert sparse_compact_page_model(names) is sparse_compact_page_model(names)
@@ -0,0 +1,41 @@
+import uuid
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.crud import NUMERO_MAX, _build_document_requests_stmt, _numero_term
+from app.schemas import DocumentRequestFilter, Principal
+
+ADMIN = Principal(id=uuid.uuid4(), type="admin", is_active=True)
+STUDENT = Principal(id=uuid.uuid4(), type="etudiant", is_active=True)
+
+
+def _where(search_term, principal=ADMIN):
+    stmt = _build_document_requests_stmt(DocumentRequestFilter(search_term=search_term), principal)
+    return str(stmt.whereclause.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+@pytest.mark.parametrize("term, numero", [
+    ("42", 42),
+    (str(NUMERO_MAX), NUMERO_MAX),
+    ("98765432101", None),  # matricule de 11 chiffres : hors de l'int32 de numero
+    ("²", None),  # chiffre Unicode : isdigit() est vrai, int() échoue
+    ("١٢", None),
+    ("Rakoto", None),
+])
+def test_numero_term(term, numero):
+    assert _numero_term(term) == numero
+
+
+def test_numeric_term_matches_numero_or_matricule():
+    where = _where("42")
+    assert "document.numero = 42" in where
+    assert "users.matricule = '42'" in where
+
+
+@pytest.mark.parametrize("principal", [ADMIN, STUDENT])
+@pytest.mark.parametrize("term", ["98765432101", "²"])
+def test_non_numero_term_is_a_text_search(term, principal):
+    where = _where(term, principal)
+    assert "numero" not in where
+    assert "users.matricule ILIKE" in where and term in where
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+from fastapi_mail import ConnectionConfig, MessageSchema, MessageType
+
+from app.services.mail_service import MailSender, _envelope
+
+
+def _message(recipients, subject="Demande validée", body="<p>Bonjour</p>", **kwargs):
+    return MessageSchema(subject=subject, recipients=recipients, body=body, subtype=MessageType.html, **kwargs)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def sender():
+    config = ConnectionConfig(
+        MAIL_USERNAME="user",
+        MAIL_PASSWORD="password",
+        MAIL_FROM="noreply@example.com",
+        MAIL_FROM_NAME="Scolarité",
+        MAIL_PORT=1025,
+        MAIL_SERVER="localhost",
+        MAIL_STARTTLS=False,
+        MAIL_SSL_TLS=False,
+        SUPPRESS_SEND=1,
+    )
+    return MailSender(config=config, max_attempts=3)
+
+
+def test_envelope_dedupes_to_cc_and_bcc():
+    message = _message(["a@example.com", "b@example.com"], cc=["b@example.com"], bcc=["c@example.com"])
+    assert _envelope(message) == ["a@example.com", "b@example.com", "c@example.com"]
+
+
+def test_identical_messages_share_one_envelope(loop):
+    first, second = loop.create_future(), loop.create_future()
+    groups = MailSender._coalesce([
+        (_message(["a@example.com"]), first, 3),
+        (_message(["b@example.com", "a@example.com"]), second, 3),
+    ])
+    assert len(groups) == 1
+    _, recipients, futures, _ = groups[0]
+    assert recipients == ["a@example.com", "b@example.com"]
+    assert futures == [first, second]
+
+
+def test_different_messages_are_not_merged(loop):
+    groups = MailSender._coalesce([
+        (_message(["a@example.com"], subject="Demande validée"), loop.create_future(), 3),
+        (_message(["b@example.com"], subject="Demande refusée"), loop.create_future(), 3),
+        (_message(["c@example.com"], body="<p>Autre</p>"), loop.create_future(), 3),
+    ])
+    assert [recipients for _, recipients, _, _ in groups] == [["a@example.com"], ["b@example.com"], ["c@example.com"]]
+
+
+def test_messages_with_cc_are_sent_alone(loop):
+    groups = MailSender._coalesce([
+        (_message(["a@example.com"], cc=["x@example.com"]), loop.create_future(), 3),
+        (_message(["b@example.com"], cc=["x@example.com"]), loop.create_future(), 3),
+    ])
+    assert [recipients for _, recipients, _, _ in groups] == [
+        ["a@example.com", "x@example.com"],
+        ["b@example.com", "x@example.com"],
+    ]
+
+
+def test_merged_send_uses_the_smallest_attempt_budget(loop):
+    groups = MailSender._coalesce([
+        (_message(["a@example.com"]), loop.create_future(), 3),
+        (_message(["b@example.com"]), loop.create_future(), 1),
+    ])
+    assert [attempts for *_, attempts in groups] == [1]
+
+
+@pytest.mark.parametrize("max_attempts, expected", [(None, 3), (1, 1)])
+def test_send_retries_only_up_to_max_attempts(sender, loop, max_attempts, expected):
+    sender.config.SUPPRESS_SEND = 0
+    sender.retry_backoff = 0
+    calls = []
+
+    async def refused():
+        calls.append(1)
+        raise ConnectionRefusedError("SMTP down")
+
+    sender._connection = refused
+
+    async def scenario():
+        try:
+            with pytest.raises(ConnectionRefusedError):
+                await sender.send(_message(["a@example.com"]), max_attempts=max_attempts)
+        finally:
+            await sender.stop()
+
+    loop.run_until_complete(scenario())
+    assert len(calls) == expected
+
+
+def test_merged_message_hides_recipients(sender, loop):
+    message, recipients, _, _ = MailSender._coalesce([
+        (_message(["a@example.com"]), loop.create_future(), 3),
+        (_message(["b@example.com"]), loop.create_future(), 3),
+    ])[0]
+    mime = sender._build_message(message, recipients)
+    assert mime["To"] == "undisclosed-recipients:;"
+    assert "b@example.com" not in mime.as_string()
+
+
+def test_single_message_keeps_its_headers(sender):
+    message = _message(["a@example.com"], cc=["x@example.com"])
+    mime = sender._build_message(message, _envelope(message))
+    assert [address.addr_spec for address in mime["To"].addresses] == ["a@example.com"]
+    assert [address.addr_spec for address in mime["Cc"].addresses] == ["x@example.com"]
+    assert mime["From"] == "Scolarité <noreply@example.com>"
+    assert mime.get_content_subtype() == "html"
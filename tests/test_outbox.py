@@ -0,0 +1,117 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select
+
+from app.models import Outbox, OutboxKind, OutboxStatus, TypeNotif
+from app.services import outbox
+from app.services.outbox import OutboxDispatcher
+
+pytestmark = pytest.mark.anyio
+
+
+async def _ok(payload):
+    pass
+
+
+async def _boom(payload):
+    raise RuntimeError("boom")
+
+
+async def _add(session_factory, *entries):
+    async with session_factory() as db:
+        db.add_all(entries)
+        await db.commit()
+        return [entry.id for entry in entries]
+
+
+async def _rows(session_factory):
+    async with session_factory() as db:
+        return {row.id: row for row in (await db.execute(select(Outbox))).scalars()}
+
+
+async def test_email_handler_leaves_retries_to_the_outbox(monkeypatch):
+    calls = []
+
+    async def send(message, max_attempts=None):
+        calls.append(max_attempts)
+
+    monkeypatch.setattr(outbox, "send_email_now", send)
+    payload = {
+        "email": {"receivers": ["a@example.com"], "subject": "Sujet", "body": "Bonjour"},
+        "type_notif": TypeNotif.VALIDATION.value,
+    }
+    await outbox.DEFAULT_HANDLERS[OutboxKind.EMAIL.value](payload)
+    assert calls == [1]
+
+
+async def test_dispatched_rows_are_marked_sent(session_factory):
+    await _add(session_factory, Outbox(kind="ably", payload={}), Outbox(kind="websocket", payload={}))
+    dispatcher = OutboxDispatcher(session_factory, handlers={"ably": _ok, "websocket": _ok})
+
+    assert await dispatcher.run_once() == 2
+    assert {(row.status, row.attempts) for row in (await _rows(session_factory)).values()} == {("sent", 1)}
+    assert await dispatcher.run_once() == 0
+
+
+async def test_failures_back_off_then_give_up(session_factory):
+    [entry_id] = await _add(session_factory, Outbox(kind="email", payload={}))
+    dispatcher = OutboxDispatcher(session_factory, handlers={"email": _boom}, max_attempts=2, backoff_seconds=60)
+
+    await dispatcher.run_once()
+    row = (await _rows(session_factory))[entry_id]
+    assert (row.status, row.attempts, row.last_error) == ("pending", 1, "boom")
+    assert row.available_at > datetime.now(timezone.utc) + timedelta(seconds=30)
+    # Pas encore disponible : rien à réserver
+    assert await dispatcher.run_once() == 0
+
+    async with session_factory() as db:
+        (await db.get(Outbox, entry_id)).available_at = datetime.now(timezone.utc)
+        await db.commit()
+    await dispatcher.run_once()
+    row = (await _rows(session_factory))[entry_id]
+    assert (row.status, row.attempts) == ("failed", 2)
+
+
+async def test_expired_lease_is_claimed_again(session_factory):
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    [expired, leased] = await _add(
+        session_factory,
+        Outbox(kind="ably", payload={}, status=OutboxStatus.PROCESSING.value, attempts=1, available_at=past),
+        Outbox(kind="ably", payload={}, status=OutboxStatus.PROCESSING.value, attempts=1,
+               available_at=datetime.now(timezone.utc) + timedelta(minutes=5)),
+    )
+    dispatcher = OutboxDispatcher(session_factory, handlers={"ably": _ok})
+
+    assert await dispatcher.run_once() == 1
+    rows = await _rows(session_factory)
+    assert (rows[expired].status, rows[expired].attempts) == ("sent", 2)
+    assert rows[leased].status == "processing"
+
+
+async def test_slow_email_does_not_delay_realtime_rows(session_factory):
+    release = asyncio.Event()
+
+    async def slow_email(payload):
+        await release.wait()
+
+    dispatcher = OutboxDispatcher(
+        session_factory, handlers={"email": slow_email, "websocket": _ok}, poll_interval=0.05
+    )
+    dispatcher.start()
+    try:
+        [email_id] = await _add(session_factory, Outbox(kind="email", payload={}))
+        await asyncio.sleep(0.2)
+        [websocket_id] = await _add(session_factory, Outbox(kind="websocket", payload={}))
+        dispatcher.wake()
+        for _ in range(50):
+            rows = await _rows(session_factory)
+            if rows[websocket_id].status == "sent":
+                break
+            await asyncio.sleep(0.05)
+        assert rows[websocket_id].status == "sent"
+        assert rows[email_id].status == "processing"
+    finally:
+        release.set()
+        await dispatcher.stop()
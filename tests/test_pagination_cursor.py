@@ -0,0 +1,100 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import text
+
+from app.crud import _decode_cursor, _encode_cursor, get_document_requests_filtered
+from app.models import Categori, Document, User
+from app.schemas import DocumentRequestFilter, Principal
+
+
+def _document(row_id, moment):
+    return Document(id=row_id, date_de_demande=moment)
+
+
+def test_cursor_round_trip():
+    moment = datetime(2025, 10, 18, 11, 23, 2, 123456, tzinfo=timezone.utc)
+    assert _decode_cursor(_encode_cursor(_document(42, moment))) == (moment, 42)
+
+
+def test_cursor_round_trip_keeps_utc_offset():
+    moment = datetime(2025, 1, 1, 8, 0, tzinfo=timezone(timedelta(hours=3)))
+    decoded, _ = _decode_cursor(_encode_cursor(_document(1, moment)))
+    assert decoded == moment
+    assert decoded.utcoffset() == timedelta(hours=3)
+
+
+def test_cursor_is_url_safe_without_padding():
+    cursor = _encode_cursor(_document(7, datetime(2025, 1, 1, tzinfo=timezone.utc)))
+    assert "=" not in cursor
+    assert "+" not in cursor and "/" not in cursor
+
+
+@pytest.mark.parametrize("cursor", ["", "not-base64!", "e30", "eyJkIjogMX0"])
+def test_invalid_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as excinfo:
+        _decode_cursor(cursor)
+    assert excinfo.value.status_code == 400
+
+
+# ==================== BASE DE DONNÉES ====================
+ADMIN = Principal(id=uuid.uuid4(), type="admin", is_active=True)
+
+
+@pytest.fixture
+async def five_documents(session_factory):
+    async with session_factory() as db:
+        user = User(id=uuid.uuid4(), email="etudiant@example.com", hashed_password="x",
+                    nom="Rakoto", prenom="Jean", is_active=True)
+        categorie = Categori(designation="Relevé", montant=10.0)
+        db.add_all([user, categorie])
+        await db.flush()
+        start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        documents = [
+            Document(user_id=user.id, categorie_id=categorie.id, date_de_demande=start + timedelta(days=day))
+            for day in range(5)
+        ]
+        db.add_all(documents)
+        await db.commit()
+    return [document.id for document in reversed(documents)]
+
+
+async def _list(session_factory, **filters):
+    async with session_factory() as db:
+        return await get_document_requests_filtered(db, DocumentRequestFilter(**filters), ADMIN)
+
+
+@pytest.mark.anyio
+async def test_approximate_count_comes_from_the_planner(session_factory, five_documents):
+    async with session_factory() as db:
+        plan = (await db.execute(text("EXPLAIN (FORMAT JSON) SELECT * FROM document"))).scalar_one()
+    _, pagination = await _list(session_factory, count="approximate", per_page=2)
+    assert pagination.total_is_estimate is True
+    assert pagination.total_items == plan[0]["Plan"]["Plan Rows"]
+    assert pagination.page_total is None
+
+
+@pytest.mark.anyio
+async def test_approximate_count_does_not_clamp_the_page(session_factory, five_documents):
+    documents, pagination = await _list(session_factory, count="approximate", per_page=2, page=9)
+    assert (documents, pagination.page) == ([], 9)
+
+    documents, pagination = await _list(session_factory, count="exact", per_page=2, page=9)
+    assert (pagination.page, pagination.page_total, pagination.total_items) == (3, 3, 5)
+    assert pagination.total_is_estimate is False
+    assert [document.id for document in documents] == five_documents[4:]
+
+
+@pytest.mark.anyio
+async def test_cursor_pages_walk_every_row_once(session_factory, five_documents):
+    seen, cursor = [], None
+    while True:
+        documents, pagination = await _list(session_factory, mode="cursor", count="none", per_page=2, cursor=cursor)
+        seen += [document.id for document in documents]
+        assert pagination.total_items is None
+        cursor = pagination.next_cursor
+        if cursor is None:
+            break
+    assert seen == five_documents
@@ -0,0 +1,72 @@
+import httpx
+import pytest
+
+from app import crud
+from app.database import get_db
+from app.main import app
+from app.schemas import NiveauCreateRequest, NiveauResponseSchema
+from app.services.reference_cache import reference_cache
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def cached_niveaux():
+    """Cache pré-rempli : les routes de lecture ne touchent pas la base"""
+    app.dependency_overrides[get_db] = lambda: None
+    reference_cache.invalidate()
+    reference_cache.put("niveau", [NiveauResponseSchema(id=1, designation="L1 IG")])
+    yield
+    reference_cache.invalidate()
+    app.dependency_overrides.pop(get_db, None)
+
+
+async def _get(path, **headers):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        return await client.get(path, headers=headers)
+
+
+async def test_list_carries_etag():
+    response = await _get("/niveau")
+    assert response.status_code == 200
+    assert response.json() == [{"id": 1, "designation": "L1 IG"}]
+    assert response.headers["etag"] == reference_cache.get("niveau").etag
+    assert "must-revalidate" in response.headers["cache-control"]
+
+
+@pytest.mark.parametrize("if_none_match", ["{etag}", "W/{etag}", '"autre", {etag}', "*"])
+async def test_matching_etag_answers_304(if_none_match):
+    etag = (await _get("/niveau")).headers["etag"]
+    response = await _get("/niveau", **{"If-None-Match": if_none_match.format(etag=etag)})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+
+async def test_changed_list_answers_200_with_new_etag():
+    etag = (await _get("/niveau")).headers["etag"]
+    reference_cache.put("niveau", [NiveauResponseSchema(id=1, designation="L1 IG"),
+                                   NiveauResponseSchema(id=2, designation="L2 IG")])
+
+    response = await _get("/niveau", **{"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert len(response.json()) == 2
+
+
+class _WriteSession:
+    """Session réduite aux écritures de create_niveau"""
+
+    def add(self, obj):
+        obj.id = 2
+
+    def commit(self):
+        pass
+
+    def refresh(self, obj):
+        pass
+
+
+async def test_write_invalidates_the_list():
+    crud.create_niveau(_WriteSession(), NiveauCreateRequest(designation="L2 IG"))
+    assert reference_cache.get("niveau") is None
@@ -0,0 +1,71 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from app.crud import document_fieldset, user_fieldset
+from app.schemas import (
+    DocumentRequestFilter, DocumentRequestResponse, PaginationMeta, UserRequestFilter, UserResponse,
+    sparse_model, sparse_page_model
+)
+
+
+def test_no_fields_means_full_response():
+    assert document_fieldset(DocumentRequestFilter()) is None
+    assert user_fieldset(UserRequestFilter()) is None
+
+
+def test_fields_keep_schema_order_and_always_include_id():
+    fieldset = document_fieldset(DocumentRequestFilter(fields="status, numero"))
+    assert fieldset == ("id", "numero", "status")
+
+
+def test_include_adds_relations_only():
+    fieldset = document_fieldset(DocumentRequestFilter(fields="numero", include="categorie"))
+    assert fieldset == ("id", "numero", "categorie")
+
+
+def test_include_alone_keeps_all_scalar_fields():
+    fieldset = user_fieldset(UserRequestFilter(include="niveau"))
+    assert fieldset == tuple(UserResponse.model_fields)
+
+
+@pytest.mark.parametrize("filters", [
+    DocumentRequestFilter(fields="numero,password"),
+    DocumentRequestFilter(include="niveau"),
+    DocumentRequestFilter(fields="user"),
+])
+def test_unknown_fields_are_rejected(filters):
+    with pytest.raises(HTTPException) as excinfo:
+        document_fieldset(filters)
+    assert excinfo.value.status_code == 400
+
+
+def test_sparse_model_keeps_only_requested_fields():
+    model = sparse_model(DocumentRequestResponse, ("id", "numero", "status"))
+    row = SimpleNamespace(id=1, numero=12, status="pending", pere="ignored")
+    assert model.model_validate(row).model_dump() == {"id": 1, "numero": 12, "status": "pending"}
+
+
+def test_sparse_model_keeps_field_validation():
+    model = sparse_model(DocumentRequestResponse, ("id", "date_de_demande"))
+    with pytest.raises(ValidationError):
+        model.model_validate(SimpleNamespace(id=1, date_de_demande="not a date"))
+
+
+def test_sparse_page_model_is_cached_per_fieldset():
+    names = ("id", "status")
+    assert sparse_page_model(DocumentRequestResponse, names) is sparse_page_model(DocumentRequestResponse, names)
+
+
+def test_sparse_page_model_serializes_rows_and_pagination():
+    moment = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    page = sparse_page_model(DocumentRequestResponse, ("id", "date_de_demande"))(
+        data=[SimpleNamespace(id=3, date_de_demande=moment, status="pending")],
+        pagination=PaginationMeta(page=1, page_total=1, per_page=10, total_items=1),
+    )
+    dumped = page.model_dump()
+    assert dumped["data"] == [{"id": 3, "date_de_demande": moment}]
+    assert dumped["pagination"]["total_items"] == 1
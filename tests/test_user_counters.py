@@ -0,0 +1,207 @@
+import uuid
+
+import anyio
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from app.crud import delete_document_request, mark_all_as_seen, mark_as_seen
+from app.models import Categori, Document, DocumentStatus, Notification, User, UserCounter
+from app.services.user_counters import (
+    bump_unread_notifications, bump_user_counters, document_status_delta, get_user_counters,
+    COUNTER_COLUMNS, reconcile_user_counters, status_column
+)
+
+PENDING = DocumentStatus.PENDING.value
+VALIDATE = DocumentStatus.VALIDATE.value
+REFUSE = DocumentStatus.REFUSE.value
+
+
+def test_new_request_counts_as_pending():
+    assert document_status_delta(None, PENDING) == {"documents_pending": 1}
+
+
+def test_deleted_request_leaves_its_status():
+    assert document_status_delta(VALIDATE, None) == {"documents_validate": -1}
+
+
+@pytest.mark.parametrize("old, new, delta", [
+    (PENDING, VALIDATE, {"documents_pending": -1, "documents_validate": 1}),
+    (PENDING, REFUSE, {"documents_pending": -1, "documents_refuse": 1}),
+    (REFUSE, PENDING, {"documents_refuse": -1, "documents_pending": 1}),
+])
+def test_status_change_moves_one_unit(old, new, delta):
+    assert document_status_delta(old, new) == delta
+
+
+@pytest.mark.parametrize("status", [PENDING, VALIDATE, REFUSE, None])
+def test_unchanged_status_is_empty(status):
+    assert document_status_delta(status, status) == {}
+
+
+def test_unknown_status_is_not_counted():
+    assert status_column("archived") is None
+    assert document_status_delta("archived", PENDING) == {"documents_pending": 1}
+    assert document_status_delta(PENDING, "archived") == {"documents_pending": -1}
+
+
+def test_deltas_sum_to_zero_over_a_lifecycle():
+    steps = [None, PENDING, REFUSE, PENDING, VALIDATE, None]
+    totals = {}
+    for old, new in zip(steps, steps[1:]):
+        for column, delta in document_status_delta(old, new).items():
+            totals[column] = totals.get(column, 0) + delta
+    assert not any(totals.values())
+
+
+# ==================== BASE DE DONNÉES ====================
+class _RecordingSession:
+    """Session réduite à execute() : garde les requêtes pour inspecter le SQL généré"""
+
+    def __init__(self):
+        self.statements = []
+
+    async def execute(self, stmt):
+        self.statements.append(stmt)
+
+
+def _sql(stmt):
+    return str(stmt.compile(dialect=postgresql.dialect()))
+
+
+@pytest.mark.anyio
+async def test_bump_is_one_upsert_sorted_by_user():
+    first, second = uuid.UUID(int=1), uuid.UUID(int=2)
+    db = _RecordingSession()
+    await bump_user_counters(db, {
+        second: {"documents_pending": 1},
+        first: {"unread_notifications": 2},
+        str(second): {"documents_pending": -1, "documents_validate": 1},
+    })
+
+    [stmt] = db.statements
+    sql = _sql(stmt)
+    assert "ON CONFLICT (user_id) DO UPDATE SET" in sql
+    assert "unread_notifications = (user_counter.unread_notifications + excluded.unread_notifications)" in sql
+    params = stmt.compile(dialect=postgresql.dialect()).params
+    assert [params["user_id_m0"], params["user_id_m1"]] == [first, second]
+    assert (params["documents_pending_m1"], params["documents_validate_m1"]) == (0, 1)
+
+
+@pytest.mark.anyio
+async def test_users_without_changes_are_not_written():
+    db = _RecordingSession()
+    await bump_user_counters(db, {uuid.uuid4(): {"documents_pending": 1, "documents_refuse": -1},
+                                  uuid.uuid4(): {}})
+    await bump_user_counters(db, {uuid.uuid4(): {"documents_pending": 0}})
+    await bump_unread_notifications(db, [])
+    [stmt] = db.statements
+    assert len(stmt.compile(dialect=postgresql.dialect()).params) == len(COUNTER_COLUMNS) + 1
+
+
+async def _user(db, **columns):
+    user = User(id=uuid.uuid4(), email=f"{uuid.uuid4().hex}@example.com", hashed_password="x",
+                nom="Rakoto", prenom="Jean", is_active=True, **columns)
+    db.add(user)
+    await db.flush()
+    return user
+
+
+async def _counters(session_factory, user_id):
+    async with session_factory() as db:
+        return await get_user_counters(db, user_id)
+
+
+@pytest.mark.anyio
+async def test_bump_creates_then_accumulates(session_factory):
+    async with session_factory() as db:
+        user = await _user(db)
+        await bump_user_counters(db, {user.id: {"documents_pending": 1, "unread_notifications": 2}})
+        await bump_user_counters(db, {user.id: document_status_delta(PENDING, VALIDATE)})
+        await db.commit()
+
+    counters = await _counters(session_factory, user.id)
+    assert counters == {"unread_notifications": 2, "documents_pending": 0, "documents_validate": 1, "documents_refuse": 0}
+
+
+@pytest.mark.anyio
+async def test_mark_as_seen_decrements_only_newly_read(session_factory):
+    async with session_factory() as db:
+        user, other = await _user(db), await _user(db)
+        notifications = [
+            Notification(user_id=user.id, contenu="a"),
+            Notification(user_id=user.id, contenu="b"),
+            Notification(user_id=user.id, contenu="c", vue=True),
+            Notification(user_id=other.id, contenu="d"),
+        ]
+        db.add_all(notifications)
+        await bump_unread_notifications(db, [user.id, user.id, other.id])
+        await db.commit()
+    unread, _, seen, foreign = notifications
+
+    async with session_factory() as db:
+        # Déjà lue ou appartenant à un autre utilisateur : pas de décrément
+        assert await mark_as_seen(db, [unread.id, seen.id, foreign.id], user.id) == 1
+    assert (await _counters(session_factory, user.id))["unread_notifications"] == 1
+
+    async with session_factory() as db:
+        assert await mark_all_as_seen(db, user.id) == 1
+        assert await mark_all_as_seen(db, user.id) == 0
+    assert (await _counters(session_factory, user.id))["unread_notifications"] == 0
+    assert (await _counters(session_factory, other.id))["unread_notifications"] == 1
+
+
+@pytest.mark.anyio
+async def test_delete_document_request_decrements_once(session_factory):
+    async with session_factory() as db:
+        user = await _user(db)
+        categorie = Categori(designation=f"Relevé {uuid.uuid4().hex}", montant=10.0)
+        db.add(categorie)
+        await db.flush()
+        document = Document(user_id=user.id, categorie_id=categorie.id, status=REFUSE)
+        db.add(document)
+        await bump_user_counters(db, {user.id: document_status_delta(None, REFUSE)})
+        await db.commit()
+
+    for _ in range(2):
+        async with session_factory() as db:
+            assert await delete_document_request(db, document.id)
+    assert (await _counters(session_factory, user.id))["documents_refuse"] == 0
+
+
+@pytest.mark.anyio
+async def test_reconcile_repairs_drift(session_factory):
+    async with session_factory() as db:
+        user, newcomer = await _user(db), await _user(db)
+        db.add(Notification(user_id=user.id, contenu="a"))
+        await bump_user_counters(db, {user.id: {"unread_notifications": 5, "documents_pending": -1}})
+        await db.commit()
+
+    async with session_factory() as db:
+        assert await reconcile_user_counters(db, batch_size=1) == 1
+        # Une ligne de compteurs a été créée pour l'utilisateur qui n'en avait pas
+        assert await db.get(UserCounter, newcomer.id) is not None
+    assert await _counters(session_factory, user.id) == {
+        "unread_notifications": 1, "documents_pending": 0, "documents_validate": 0, "documents_refuse": 0
+    }
+
+
+@pytest.mark.anyio
+async def test_reconcile_skips_rows_locked_by_a_writer(session_factory):
+    async with session_factory() as db:
+        user = await _user(db)
+        await bump_user_counters(db, {user.id: {"unread_notifications": 3}})
+        await db.commit()
+
+    async with session_factory() as writer:
+        # Transaction concurrente qui tient le verrou de la ligne
+        await writer.execute(select(UserCounter).where(UserCounter.user_id == user.id).with_for_update())
+        async with session_factory() as db:
+            with anyio.fail_after(5):
+                assert await reconcile_user_counters(db) == 0
+        await writer.rollback()
+
+    assert (await _counters(session_factory, user.id))["unread_notifications"] == 3
+    async with session_factory() as db:
+        assert await reconcile_user_counters(db) == 1
+    assert (await _counters(session_factory, user.id))["unread_notifications"] == 0